@@ -0,0 +1,455 @@
+"""Asyncio variant of moltin store api.
+
+Functions mirror the ones in `store.py` and share its catalog cache.
+Synchronous code awaits them through `run` and `gather`, which execute
+coroutines on one background event loop with a shared connection pool.
+Error statuses raise `requests.HTTPError`, as in `store.py`, and
+blocking cache calls that may reach redis run in the default executor.
+"""
+import asyncio
+import threading
+import time
+
+import aiohttp
+import requests
+
+from cache import MISSING
+from circuit import breakers
+from metrics import get_moltin_endpoint, track_upstream
+from rate_limit import RequestStats, get_retry_delay, should_retry
+from store import (
+    DEFAULT_MAX_RETRIES, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, MOLTIN_API_URL,
+    PIZZERIAS_FLOW_SLUG, catalog_cache, is_upstream_failure)
+
+
+def raise_for_status(response):
+    """Raise requests.HTTPError for an error status, as store.py does."""
+    if response.status < 400:
+        return
+    sync_response = requests.Response()
+    sync_response.status_code = response.status
+    sync_response.reason = response.reason
+    sync_response.url = str(response.url)
+    sync_response.headers.update(response.headers)
+    sync_response.raise_for_status()
+
+
+async def run_blocking(function, *args):
+    """Call blocking function in the default executor."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, function, *args,
+    )
+
+
+class AsyncMoltinClient:
+    """Moltin api client on top of one aiohttp session."""
+
+    def __init__(
+        self,
+        base_url=MOLTIN_API_URL,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+        rate_limiter=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.stats = RequestStats()
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+            self.timeout = aiohttp.ClientTimeout(
+                sock_connect=connect_timeout,
+                sock_read=read_timeout,
+            )
+        else:
+            self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+            )
+        return self.session
+
+    async def request(self, method, path, access_token=None, headers=None,
+                      **kwargs):
+        """Send request to moltin api and return decoded json.
+
+        Retries follow the same rules as `store.MoltinClient.request`.
+        """
+        request_headers = {}
+        if access_token:
+            request_headers['Authorization'] = f'Bearer {access_token}'
+        request_headers.update(headers or {})
+        endpoint = get_moltin_endpoint(method, path)
+        return await self.send(
+            method, path, endpoint, request_headers, **kwargs,
+        )
+
+    async def send(self, method, path, endpoint, headers, **kwargs):
+        """Send request, repeating it while it may be retried.
+
+        Every attempt is counted by the circuit breaker on its own.
+        """
+        breaker = breakers.get(f'moltin {endpoint}')
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                waited = await run_blocking(self.rate_limiter.acquire)
+                if waited:
+                    self.stats.count('budget_waits')
+            breaker.allow()
+            self.stats.count('requests')
+            started_at = time.monotonic()
+            failed = True
+            try:
+                with track_upstream('moltin', endpoint):
+                    async with self.get_session().request(
+                        method,
+                        f'{self.base_url}{path}',
+                        headers=headers,
+                        **kwargs,
+                    ) as response:
+                        if response.status == 429:
+                            self.stats.count('throttled')
+                        if (
+                            attempt == self.max_retries
+                            or not should_retry(method, response.status)
+                        ):
+                            failed = is_upstream_failure(response.status)
+                            raise_for_status(response)
+                            if response.content_length == 0:
+                                return None
+                            return await response.json(content_type=None)
+                        failed = is_upstream_failure(response.status)
+                        delay = get_retry_delay(response.headers, attempt)
+            finally:
+                breaker.record(time.monotonic() - started_at, failed)
+            self.stats.count('retried')
+            await asyncio.sleep(delay)
+
+    async def download(self, link):
+        breaker = breakers.get('moltin GET file content')
+        breaker.allow()
+        started_at = time.monotonic()
+        failed = True
+        try:
+            with track_upstream('moltin', 'GET file content'):
+                async with self.get_session().get(link) as response:
+                    raise_for_status(response)
+                    content = await response.read()
+            failed = False
+            return content
+        finally:
+            breaker.record(time.monotonic() - started_at, failed)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+client = AsyncMoltinClient()
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return background event loop, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever,
+                name='async-store',
+                daemon=True,
+            ).start()
+        return _loop
+
+
+def run(coroutine):
+    """Run coroutine on background loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+
+def gather(*coroutines):
+    """Run coroutines concurrently and return their results in order."""
+    async def gather_all():
+        return await asyncio.gather(*coroutines)
+    return run(gather_all())
+
+
+def configure_client(
+    base_url=MOLTIN_API_URL,
+    pool_size=DEFAULT_POOL_SIZE,
+    timeout=DEFAULT_TIMEOUT,
+    rate_limiter=None,
+    max_retries=DEFAULT_MAX_RETRIES,
+):
+    """Replace module client with a newly configured one."""
+    global client
+    old_client = client
+    client = AsyncMoltinClient(
+        base_url=base_url,
+        pool_size=pool_size,
+        timeout=timeout,
+        rate_limiter=rate_limiter,
+        max_retries=max_retries,
+    )
+    run(old_client.close())
+    return client
+
+
+async def load_cached(key, loader):
+    """Async `catalog_cache.get_or_refresh`."""
+    value, fresh = catalog_cache.lookup(key)
+    if fresh:
+        return value
+    if value is not MISSING:
+        catalog_cache.refresh_in_background(key, lambda: run(loader()))
+        return value
+    version = catalog_cache.version
+    value, fresh = await run_blocking(
+        catalog_cache.load_shared, key, version,
+    )
+    if value is not MISSING:
+        if not fresh:
+            catalog_cache.refresh_in_background(key, lambda: run(loader()))
+        return value
+    value = await loader()
+    await run_blocking(catalog_cache.store, key, value, version)
+    return value
+
+
+async def authenticate(client_id, client_secret):
+    """Authenticate."""
+    payload = await client.request(
+        'POST',
+        '/oauth/access_token',
+        data={
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
+    )
+    return {'token': payload['access_token'], 'expires': payload['expires']}
+
+
+async def get_all_products(access_token):
+    """Get all products in store."""
+    async def load():
+        payload = await client.request('GET', '/v2/products', access_token)
+        return payload['data']
+    return await load_cached('products', load)
+
+
+async def get_file(file_id, access_token):
+    """Get image file."""
+    async def load():
+        payload = await client.request(
+            'GET', f'/v2/files/{file_id}', access_token,
+        )
+        return payload['data']
+    return await load_cached(('file', file_id), load)
+
+
+async def get_photo(link):
+    """Download photo by bytes."""
+    return await client.download(link)
+
+
+async def get_product(product_id, access_token):
+    """Get a specific product."""
+    async def load():
+        payload = await client.request(
+            'GET', f'/v2/products/{product_id}', access_token,
+        )
+        return payload['data']
+    return await load_cached(('product', product_id), load)
+
+
+async def get_cart(client_id, access_token):
+    """Get a cart."""
+    payload = await client.request(
+        'GET', f'/v2/carts/{client_id}', access_token,
+    )
+    return payload['data']
+
+
+async def get_cart_items(client_id, access_token):
+    """Get all items in store cart."""
+    payload = await client.request(
+        'GET', f'/v2/carts/{client_id}/items', access_token,
+    )
+    return payload['data']
+
+
+async def add_to_cart(client_id, product_id, quantity, access_token):
+    """Add a product to cart."""
+    return await client.request(
+        'POST',
+        f'/v2/carts/{client_id}/items',
+        access_token,
+        headers={'X-MOLTIN-CURRENCY': 'RUB'},
+        json={
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': quantity,
+            }},
+    )
+
+
+async def remove_product_from_cart(product_id, cart_id, access_token):
+    """Remove a product from cart."""
+    return await client.request(
+        'DELETE', f'/v2/carts/{cart_id}/items/{product_id}', access_token,
+    )
+
+
+async def check_customer(email, access_token):
+    """Find customer id by email with moltin filter."""
+    payload = await client.request(
+        'GET',
+        '/v2/customers',
+        access_token,
+        params={'filter': f'eq(email,{email.lower()})'},
+    )
+    for customer in payload['data']:
+        if customer['email'].lower() == email.lower():
+            return customer['id']
+
+
+async def create_customer(email, access_token):
+    """Create a customer and return its id."""
+    payload = await client.request(
+        'POST',
+        '/v2/customers',
+        access_token,
+        json={
+            'data': {
+                'type': 'customer',
+                'name': email,
+                'email': email,
+            }
+        },
+    )
+    return payload['data']['id']
+
+
+async def create_product(access_token, payload):
+    """Create a product."""
+    response = await client.request(
+        'POST', '/v2/products', access_token, json={'data': payload},
+    )
+    await run_blocking(catalog_cache.invalidate)
+    return response
+
+
+async def create_file(access_token, file_location):
+    """Create a file."""
+    form = aiohttp.FormData()
+    form.add_field('file_location', file_location)
+    return await client.request('POST', '/v2/files', access_token, data=form)
+
+
+async def create_image_relationship(access_token, productId, imageId):
+    """Create relationship between file and product."""
+    response = await client.request(
+        'POST',
+        f'/v2/products/{productId}/relationships/main-image',
+        access_token,
+        json={
+            'data': {
+                'type': 'main_image',
+                'id': imageId,
+            },
+        }
+    )
+    await run_blocking(catalog_cache.invalidate)
+    return response
+
+
+async def create_flow(access_token, name, slug, description, enabled):
+    """Create a flow."""
+    return await client.request(
+        'POST',
+        '/v2/flows',
+        access_token,
+        json={
+            'data': {
+                'type': 'flow',
+                'name': name,
+                'slug': slug,
+                'description': description,
+                'enabled': enabled,
+            },
+        }
+    )
+
+
+async def create_field(access_token, name, slug, field_type, description,
+                       required, enabled, flowId):
+    """Create a field in flow."""
+    return await client.request(
+        'POST',
+        '/v2/fields',
+        access_token,
+        json={
+            'data': {
+                'type': 'field',
+                'name': name,
+                'slug': slug,
+                'field_type': field_type,
+                'description': description,
+                'required': required,
+                'enabled': enabled,
+                'relationships': {
+                    'flow': {
+                        'data': {
+                            'type': 'flow',
+                            'id': flowId,
+                        }
+                    }
+                },
+            },
+        }
+    )
+
+
+async def get_flow(access_token, flowId):
+    """Get a flow by flowId."""
+    return await client.request('GET', f'/v2/flows/{flowId}', access_token)
+
+
+async def create_entry(access_token, flow_slug, field_values):
+    """Create an entry in flow."""
+    json = {
+        'data': {
+            'type': 'entry',
+        }
+    }
+    for field_slug, field_value in field_values.items():
+        json['data'][field_slug] = field_value
+    response = await client.request(
+        'POST',
+        f'/v2/flows/{flow_slug}/entries',
+        access_token,
+        json=json,
+    )
+    if flow_slug == PIZZERIAS_FLOW_SLUG:
+        await run_blocking(catalog_cache.invalidate, 'pizzerias')
+    return response
+
+
+async def get_all_pizzerias(access_token):
+    """Get all entries: pizzerias."""
+    async def load():
+        payload = await client.request(
+            'GET', f'/v2/flows/{PIZZERIAS_FLOW_SLUG}/entries', access_token,
+        )
+        return payload['data']
+    return await load_cached('pizzerias', load)
@@ -0,0 +1,278 @@
+"""Benchmarks for bot hot paths."""
+import argparse
+import random
+import subprocess
+import sys
+import time
+from functools import partial
+
+import requests
+
+import async_store
+import store
+import tokens
+from fake_moltin import start_server
+from delivery import quote_deliveries, quote_delivery
+from get_location import (
+    PizzeriaIndex, get_closest_pizzeria, measure_distance)
+
+
+def bench_store_session(calls=300, latency=0):
+    """Compare one-off requests with the pooled store client."""
+    server = start_server(latency=latency)
+    url = f'{server.url}/v2/products'
+
+    started_at = time.perf_counter()
+    for _ in range(calls):
+        response = requests.get(url, timeout=10)
+        response.raise_for_status()
+    plain_elapsed = time.perf_counter() - started_at
+    plain_connections = server.connections
+
+    client = store.MoltinClient(base_url=server.url, pool_size=4)
+    started_at = time.perf_counter()
+    for _ in range(calls):
+        client.request('GET', '/v2/products', 'token')
+    pooled_elapsed = time.perf_counter() - started_at
+    pooled_connections = server.connections - plain_connections
+    client.close()
+    server.shutdown()
+
+    return {
+        'plain requests': (plain_elapsed, plain_connections),
+        'pooled client': (pooled_elapsed, pooled_connections),
+    }
+
+
+def print_store_session(results, calls):
+    for name, (elapsed, connections) in results.items():
+        print(
+            f'{name:>15}: {elapsed / calls * 1000:.3f} ms/call, '
+            f'{connections} connections for {calls} calls'
+        )
+
+
+def bench_cart_fan_out(screens=20, latency=0.05):
+    """Cart screen with sequential and concurrent moltin calls."""
+    server = start_server(latency=latency)
+    client = store.MoltinClient(base_url=server.url)
+    client.request(
+        'POST', '/v2/carts/1/items', 'token',
+        json={'data': {'id': 'product-1', 'quantity': 1}},
+    )
+
+    started_at = time.perf_counter()
+    for _ in range(screens):
+        client.request('GET', '/v2/carts/1/items', 'token')
+        client.request('GET', '/v2/carts/1', 'token')
+    sequential_elapsed = time.perf_counter() - started_at
+    client.close()
+
+    async_client = async_store.AsyncMoltinClient(base_url=server.url)
+    started_at = time.perf_counter()
+    for _ in range(screens):
+        async_store.gather(
+            async_client.request('GET', '/v2/carts/1/items', 'token'),
+            async_client.request('GET', '/v2/carts/1', 'token'),
+        )
+    concurrent_elapsed = time.perf_counter() - started_at
+    async_store.run(async_client.close())
+    server.shutdown()
+
+    return {
+        'sequential': sequential_elapsed / screens,
+        'concurrent': concurrent_elapsed / screens,
+    }
+
+
+def make_pizzerias(count, seed=0):
+    """Synthetic pizzerias scattered around Moscow."""
+    randomizer = random.Random(seed)
+    return [
+        {
+            'address': f'Пиццерия {number}',
+            'longitude': 37.6 + randomizer.uniform(-0.5, 0.5),
+            'latitude': 55.75 + randomizer.uniform(-0.3, 0.3),
+            'telegram_id_01': number,
+        }
+        for number in range(count)
+    ]
+
+
+def make_customers(count, seed=1):
+    randomizer = random.Random(seed)
+    return [
+        (37.6 + randomizer.uniform(-0.6, 0.6),
+         55.75 + randomizer.uniform(-0.4, 0.4))
+        for _ in range(count)
+    ]
+
+
+def scan_closest_pizzeria(coordinates, pizzerias):
+    """Closest pizzeria by geodesic distance to every pizzeria."""
+    customer_lon, customer_lat = coordinates
+
+    def get_distance(pizzeria):
+        return measure_distance(
+            customer_lon,
+            customer_lat,
+            pizzeria['longitude'],
+            pizzeria['latitude'],
+        )
+    return min(pizzerias, key=get_distance)
+
+
+def bench_closest_pizzeria(pizzerias_count=10000, queries=20):
+    pizzerias = make_pizzerias(pizzerias_count)
+    customers = make_customers(queries)
+
+    started_at = time.perf_counter()
+    expected = [
+        scan_closest_pizzeria(customer, pizzerias)['address']
+        for customer in customers
+    ]
+    scan_elapsed = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    PizzeriaIndex(pizzerias)
+    build_elapsed = time.perf_counter() - started_at
+
+    get_closest_pizzeria(customers[0], pizzerias)
+    started_at = time.perf_counter()
+    found = [
+        get_closest_pizzeria(customer, pizzerias)['address']
+        for customer in customers
+    ]
+    indexed_elapsed = time.perf_counter() - started_at
+    assert found == expected, 'Index found a different pizzeria'
+
+    return {
+        'geodesic scan': scan_elapsed / queries,
+        'index build': build_elapsed,
+        'indexed query': indexed_elapsed / queries,
+    }
+
+
+def bench_delivery_quotes(addresses_count=100000, pizzerias_count=100):
+    pizzerias = make_pizzerias(pizzerias_count)
+    customers = make_customers(addresses_count)
+    longitudes = [lon for lon, _ in customers]
+    latitudes = [lat for _, lat in customers]
+    started_at = time.perf_counter()
+    quote_deliveries(longitudes, latitudes, pizzerias)
+    batch_elapsed = time.perf_counter() - started_at
+
+    single_count = min(addresses_count, 200)
+    started_at = time.perf_counter()
+    for customer in customers[:single_count]:
+        quote_delivery(customer, pizzerias)
+    single_elapsed = time.perf_counter() - started_at
+    return {
+        'batch total': batch_elapsed,
+        'batch per addr': batch_elapsed / addresses_count,
+        'single quote': single_elapsed / single_count,
+    }
+
+
+def measure_import(module):
+    """Seconds to start interpreter and import module in a new process."""
+    started_at = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'import {module}'], check=True)
+    return time.perf_counter() - started_at
+
+
+def bench_startup(latency=0.05, repeat=5):
+    """Import of main and cache warm-up, task by task and concurrently."""
+    interpreter_elapsed = min(
+        measure_import('sys') for _ in range(repeat)
+    )
+    import_elapsed = min(measure_import('main') for _ in range(repeat))
+
+    import main
+    from warmup import WarmUp
+    server = start_server(latency=latency)
+    server.state.entries[store.PIZZERIAS_FLOW_SLUG] = make_pizzerias(100)
+    store.configure_client(base_url=server.url)
+    async_store.configure_client(base_url=server.url)
+    provider = tokens.token_provider = tokens.TokenProvider(
+        None, 'client', 'secret',
+    )
+    provider.token, provider.expires = 'token', time.time() + 3600
+    tasks = {
+        'moltin token': partial(store.authenticate, 'client', 'secret'),
+        'catalog': main.warm_up_catalog,
+        'pizzerias': main.warm_up_pizzerias,
+    }
+
+    # First pass opens connections, so both timed passes start equal
+    for task in tasks.values():
+        task()
+    store.catalog_cache.invalidate()
+    started_at = time.perf_counter()
+    for task in tasks.values():
+        task()
+    sequential_elapsed = time.perf_counter() - started_at
+
+    store.catalog_cache.invalidate()
+    warm_up = WarmUp()
+    warm_up.run(tasks, attempts=1)
+    if warm_up.errors:
+        raise RuntimeError(f'Warm-up failed: {warm_up.errors}')
+    async_store.run(async_store.client.close())
+    server.shutdown()
+    return {
+        'import main': import_elapsed - interpreter_elapsed,
+        'sequential': sequential_elapsed,
+        'concurrent': warm_up.elapsed,
+    }
+
+
+def print_timings(results):
+    for name, elapsed in results.items():
+        print(f'{name:>15}: {elapsed * 1000:.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run bot benchmarks.')
+    parser.add_argument(
+        'benchmarks', nargs='*',
+        help=(
+            'Any of store, cart, pizzerias, quotes, startup; '
+            'all by default.'
+        ),
+    )
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Artificial server latency per request, seconds.',
+    )
+    parser.add_argument('--pizzerias', type=int, default=10000)
+    args = parser.parse_args()
+    benchmarks = ['store', 'cart', 'pizzerias', 'quotes', 'startup']
+    unknown = set(args.benchmarks) - set(benchmarks)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    args.benchmarks = args.benchmarks or benchmarks
+    if 'store' in args.benchmarks:
+        print('Store session, local fake moltin over plain http:')
+        print_store_session(
+            bench_store_session(args.calls, args.latency), args.calls,
+        )
+    if 'cart' in args.benchmarks:
+        latency = args.latency or 0.05
+        print(f'Cart screen, two calls with {latency * 1000:.0f} ms latency:')
+        print_timings(bench_cart_fan_out(latency=latency))
+    if 'pizzerias' in args.benchmarks:
+        print(f'Closest pizzeria among {args.pizzerias} pizzerias:')
+        print_timings(bench_closest_pizzeria(args.pizzerias))
+    if 'quotes' in args.benchmarks:
+        print('Delivery quotes for 100000 addresses and 100 pizzerias:')
+        print_timings(bench_delivery_quotes())
+    if 'startup' in args.benchmarks:
+        latency = args.latency or 0.05
+        print(f'Start, warm-up with {latency * 1000:.0f} ms latency:')
+        print_timings(bench_startup(latency))
+
+
+if __name__ == '__main__':
+    main()
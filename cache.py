@@ -0,0 +1,214 @@
+"""In-process caches."""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MISSING = object()
+
+logger = logging.getLogger('Logger')
+_refresh_executor = ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix='cache-refresh',
+)
+
+
+class TTLCache:
+    """Size bounded LRU cache with expiring entries and hit counters.
+
+    `version` grows on every invalidation, so anything derived from
+    cached data can tell that it has to be rebuilt.
+
+    Expired entries are kept `stale_ttl` seconds more for
+    `get_or_refresh`, which serves them while loading a fresh value
+    in background. With a `shared` tier `get_or_refresh` looks there
+    before loading and puts loaded values there, so processes load
+    each value once.
+    """
+
+    def __init__(self, maxsize=256, ttl=300, stale_ttl=0, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.shared = shared
+        self.version = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, version=None, ttl=None):
+        """Store value unless cache was invalidated since `version`."""
+        with self._lock:
+            if version is not None and version != self.version:
+                return False
+            expires_at = time.monotonic() + (
+                self.ttl if ttl is None else ttl
+            )
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def store(self, key, value, version=None):
+        """Set value here and in the shared tier."""
+        if self.set(key, value, version) and self.shared is not None:
+            try:
+                self.shared.set(key, value, self.ttl, self.stale_ttl)
+            except Exception as error:
+                logger.warning(f'Shared cache write failed: {error}')
+
+    def load_shared(self, key, version):
+        """Copy value from the shared tier, return it and its freshness."""
+        if self.shared is None:
+            return MISSING, False
+        try:
+            entry = self.shared.get(key)
+        except Exception as error:
+            logger.warning(f'Shared cache read failed: {error}')
+            return MISSING, False
+        if entry is None:
+            return MISSING, False
+        value, expires_in = entry
+        self.set(key, value, version, ttl=expires_in)
+        return value, expires_in > 0
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is MISSING:
+            version = self.version
+            value = loader()
+            self.set(key, value, version)
+        return value
+
+    def lookup(self, key):
+        """Return value and whether it is fresh; MISSING when too old."""
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is None or entry[0] + self.stale_ttl < now:
+                self.misses += 1
+                return MISSING, False
+            self._entries.move_to_end(key)
+            if entry[0] < now:
+                self.stale_hits += 1
+                return entry[1], False
+            self.hits += 1
+            return entry[1], True
+
+    def get_or_refresh(self, key, loader):
+        """Like `get_or_load`, but a stale value is returned at once."""
+        value, fresh = self.lookup(key)
+        if fresh:
+            return value
+        if value is not MISSING:
+            self.refresh_in_background(key, loader)
+            return value
+        version = self.version
+        value, fresh = self.load_shared(key, version)
+        if value is not MISSING:
+            if not fresh:
+                self.refresh_in_background(key, loader)
+            return value
+        value = loader()
+        self.store(key, value, version)
+        return value
+
+    def refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            version = self.version
+        _refresh_executor.submit(self._refresh, key, loader, version)
+
+    def _refresh(self, key, loader, version):
+        try:
+            self.store(key, loader(), version)
+        except Exception as error:
+            logger.warning(f'Background refresh of {key!r} failed: {error}')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        """Drop one key or, without key, the whole cache."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+            self.version += 1
+        if self.shared is not None:
+            try:
+                self.shared.invalidate(key)
+            except Exception as error:
+                logger.warning(f'Shared cache invalidation failed: {error}')
+
+    def stats(self):
+        with self._lock:
+            hits = self.hits + self.stale_hits
+            requests_count = hits + self.misses
+            return {
+                'size': len(self._entries),
+                'version': self.version,
+                'hits': hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': hits / requests_count if requests_count else 0,
+            }
+
+
+class RedisCacheTier:
+    """Shared tier of TTLCache: json values in one redis hash.
+
+    Keys have to be json serializable; tuples come back as lists, so
+    they are only used to name the field.
+    """
+
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key
+
+    def get(self, key):
+        """Value and seconds until it expires, None when too old."""
+        raw = self.db.hget(self.key, json.dumps(key))
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        now = time.time()
+        if entry['stale_until'] < now:
+            return None
+        return entry['value'], entry['expires_at'] - now
+
+    def set(self, key, value, ttl, stale_ttl=0):
+        now = time.time()
+        entry = {
+            'value': value,
+            'expires_at': now + ttl,
+            'stale_until': now + ttl + stale_ttl,
+        }
+        pipeline = self.db.pipeline(transaction=False)
+        pipeline.hset(self.key, json.dumps(key), json.dumps(entry))
+        pipeline.expire(self.key, int(ttl + stale_ttl) + 1)
+        pipeline.execute()
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.db.delete(self.key)
+        else:
+            self.db.hdel(self.key, json.dumps(key))
@@ -0,0 +1,61 @@
+"""Local copy of moltin carts kept in redis.
+
+Cart changes go to moltin first and the cart items it answers with
+replace the local copy. The copy expires after `ttl` seconds and is
+then read from moltin again; checkout reconciles it explicitly.
+"""
+import json
+
+from store import add_to_cart, get_cart_items, remove_product_from_cart
+
+CART_KEY_PREFIX = 'cart:'
+DEFAULT_CART_MIRROR_TTL = 10 * 60
+
+cart_mirror_settings = {'ttl': DEFAULT_CART_MIRROR_TTL}
+
+
+def configure_cart_mirror(ttl=DEFAULT_CART_MIRROR_TTL):
+    cart_mirror_settings['ttl'] = ttl
+
+
+def save_cart_items(db, client_id, cart_items):
+    db.set(
+        f'{CART_KEY_PREFIX}{client_id}',
+        json.dumps(cart_items),
+        ex=cart_mirror_settings['ttl'],
+    )
+
+
+def get_mirrored_cart_items(db, client_id, access_token):
+    """Cart items from redis, from moltin when there is no local copy."""
+    cart_items = db.get(f'{CART_KEY_PREFIX}{client_id}')
+    if cart_items is not None:
+        return json.loads(cart_items)
+    return reconcile_cart(db, client_id, access_token)
+
+
+def reconcile_cart(db, client_id, access_token):
+    """Replace local copy with cart items from moltin."""
+    cart_items = get_cart_items(client_id, access_token)
+    save_cart_items(db, client_id, cart_items)
+    return cart_items
+
+
+def add_cart_item(db, client_id, product_id, quantity, access_token):
+    payload = add_to_cart(client_id, product_id, quantity, access_token)
+    save_cart_items(db, client_id, payload['data'])
+    return payload['data']
+
+
+def remove_cart_item(db, client_id, item_id, access_token):
+    payload = remove_product_from_cart(
+        product_id=item_id,
+        cart_id=client_id,
+        access_token=access_token,
+    )
+    save_cart_items(db, client_id, payload['data'])
+    return payload['data']
+
+
+def get_cart_total(cart_items):
+    return sum(item['value']['amount'] for item in cart_items)
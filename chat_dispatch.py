@@ -0,0 +1,122 @@
+"""Concurrent update handling with strict per-chat ordering."""
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import chat_queue_depth
+
+DEFAULT_CHAT_WORKERS = 8
+
+logger = logging.getLogger('Logger')
+
+
+class ChatExecutor:
+    """Run updates of different chats in parallel, of one chat in order.
+
+    A chat with a running update gets its next updates queued; the
+    worker that finishes an update picks the next one of the same chat.
+    Updates without a chat (chat_id None) have nothing to keep in order
+    and go straight to the pool.
+    """
+
+    def __init__(self, max_workers=DEFAULT_CHAT_WORKERS):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='chat',
+        )
+        self.processed = 0
+        self.max_depth_seen = 0
+        self.running_without_chat = 0
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, task):
+        if chat_id is None:
+            with self._lock:
+                self.running_without_chat += 1
+            self.executor.submit(self._run_without_chat, task)
+            return
+        with self._lock:
+            pending = self._queues.get(chat_id)
+            if pending is not None:
+                pending.append(task)
+                self.max_depth_seen = max(
+                    self.max_depth_seen, len(pending) + 1,
+                )
+                return
+            self._queues[chat_id] = deque()
+        self.executor.submit(self._run, chat_id, task)
+
+    def _run_task(self, task):
+        try:
+            task()
+        except Exception:
+            logger.exception('Update handling failed')
+
+    def _run_without_chat(self, task):
+        self._run_task(task)
+        with self._lock:
+            self.processed += 1
+            self.running_without_chat -= 1
+
+    def _run(self, chat_id, task):
+        while True:
+            self._run_task(task)
+            with self._lock:
+                self.processed += 1
+                pending = self._queues[chat_id]
+                if not pending:
+                    del self._queues[chat_id]
+                    return
+                task = pending.popleft()
+
+    def stats(self):
+        with self._lock:
+            depths = [len(pending) for pending in self._queues.values()]
+            return {
+                'workers': self.max_workers,
+                'active_chats': len(depths),
+                'queued_updates': sum(depths),
+                'max_queue_depth': max(depths, default=0),
+                'max_queue_depth_seen': self.max_depth_seen,
+                'running_without_chat': self.running_without_chat,
+                'processed': self.processed,
+            }
+
+    def is_busy(self):
+        with self._lock:
+            return bool(self._queues or self.running_without_chat)
+
+    def get_queue_depths(self):
+        """Queued updates of every chat with one being handled."""
+        with self._lock:
+            return {
+                (chat_id,): len(pending)
+                for chat_id, pending in self._queues.items()
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+chat_executor = None
+
+
+def start_chat_executor(max_workers=DEFAULT_CHAT_WORKERS):
+    global chat_executor
+    chat_executor = ChatExecutor(max_workers)
+    chat_queue_depth.collect = chat_executor.get_queue_depths
+    return chat_executor
+
+
+def dispatch_by_chat(callback, update, context):
+    """Hand update over to chat executor and return immediately."""
+    chat_id = update.effective_chat.id if update.effective_chat else None
+
+    def handle_update():
+        try:
+            callback(update, context)
+        except Exception as error:
+            context.dispatcher.dispatch_error(update, error)
+    chat_executor.submit(chat_id, handle_update)
@@ -0,0 +1,123 @@
+"""Circuit breakers for calls to external apis.
+
+After `failure_threshold` failed or too slow calls in a row a breaker
+opens and calls fail at once with CircuitOpenError instead of waiting
+for a dead upstream. After `reset_timeout` seconds one trial call is
+let through: its success closes the breaker, its failure opens it again.
+"""
+import threading
+import time
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_LATENCY_BUDGET = 5
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Upstream is considered down, the call was not made."""
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 latency_budget=DEFAULT_LATENCY_BUDGET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may be made now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if (
+                self.state == OPEN
+                and time.monotonic() - self.opened_at >= self.reset_timeout
+            ):
+                self.state = HALF_OPEN
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f'{self.name} is unavailable')
+
+    def record(self, duration, failed=False):
+        """Count finished call; one slower than the budget is a failure."""
+        failed = failed or duration > self.latency_budget
+        with self._lock:
+            if not failed:
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if (
+                self.state == HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, function, *args, **kwargs):
+        """Call function through the breaker; any exception is a failure."""
+        self.allow()
+        started_at = time.monotonic()
+        failed = True
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self.record(time.monotonic() - started_at, failed)
+
+
+class BreakerRegistry:
+    """Breakers created on first use, one per upstream endpoint."""
+
+    def __init__(self):
+        self.settings = {
+            'failure_threshold': DEFAULT_FAILURE_THRESHOLD,
+            'reset_timeout': DEFAULT_RESET_TIMEOUT,
+            'latency_budget': DEFAULT_LATENCY_BUDGET,
+        }
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(name)
+                if breaker is None:
+                    breaker = self.breakers[name] = CircuitBreaker(
+                        name, **self.settings,
+                    )
+        return breaker
+
+    def configure(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                  reset_timeout=DEFAULT_RESET_TIMEOUT,
+                  latency_budget=DEFAULT_LATENCY_BUDGET):
+        with self._lock:
+            self.settings = {
+                'failure_threshold': failure_threshold,
+                'reset_timeout': reset_timeout,
+                'latency_budget': latency_budget,
+            }
+            self.breakers = {}
+
+    def get_open(self):
+        """Names of breakers that are not closed now."""
+        return sorted(
+            name for name, breaker in list(self.breakers.items())
+            if breaker.state != CLOSED
+        )
+
+
+breakers = BreakerRegistry()
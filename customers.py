@@ -0,0 +1,25 @@
+"""Local index of moltin customers by email."""
+from store import check_customer, create_customer
+
+CUSTOMER_IDS_KEY = 'customer_ids'
+
+
+def get_customer_id(db, email, access_token):
+    """Find customer id in redis index, then in moltin."""
+    email = email.lower()
+    customer_id = db.hget(CUSTOMER_IDS_KEY, email)
+    if customer_id:
+        return customer_id.decode('utf-8')
+    customer_id = check_customer(email=email, access_token=access_token)
+    if customer_id:
+        db.hset(CUSTOMER_IDS_KEY, email, customer_id)
+    return customer_id
+
+
+def get_or_create_customer(db, email, access_token):
+    """Return id of customer with email, creating one if needed."""
+    customer_id = get_customer_id(db, email, access_token)
+    if not customer_id:
+        customer_id = create_customer(email, access_token)
+        db.hset(CUSTOMER_IDS_KEY, email.lower(), customer_id)
+    return customer_id
@@ -0,0 +1,138 @@
+"""Delivery quotes: closest pizzeria, distance, tariff tier and price.
+
+A tariff table is a sorted sequence of `(max_distance_km, price)` rows.
+A distance belongs to the first row whose bound it does not exceed;
+the last bound itself is already out of the delivery zone.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+from dotenv import load_dotenv
+
+from get_location import get_closest_pizzeria, get_pizzeria_index
+from store import authenticate, get_all_pizzerias
+
+DEFAULT_TARIFFS = ((0.5, 0), (5, 100), (20, 300))
+
+delivery_settings = {'tariffs': DEFAULT_TARIFFS}
+
+
+def configure_tariffs(tariffs=DEFAULT_TARIFFS):
+    delivery_settings['tariffs'] = tuple(sorted(tariffs))
+
+
+def parse_tariffs(text):
+    """Parse tariffs written as `0.5:0,5:100,20:300`."""
+    tariffs = []
+    for row in text.split(','):
+        max_distance, price = row.split(':')
+        tariffs.append((float(max_distance), int(price)))
+    return tuple(sorted(tariffs))
+
+
+def get_tier(distance, tariffs=None):
+    """Tariff row number for distance, None when out of the zone."""
+    tariffs = tariffs or delivery_settings['tariffs']
+    if not 0 <= distance < tariffs[-1][0]:
+        return None
+    for tier, (max_distance, _) in enumerate(tariffs):
+        if distance <= max_distance:
+            return tier
+
+
+def quote_delivery(coordinates, pizzerias, tariffs=None):
+    """Quote delivery to one point with exact geodesic distance."""
+    tariffs = tariffs or delivery_settings['tariffs']
+    pizzeria = get_closest_pizzeria(coordinates, pizzerias)
+    tier = get_tier(pizzeria['distance'], tariffs)
+    return {
+        'pizzeria': pizzeria,
+        'distance': pizzeria['distance'],
+        'tier': tier,
+        'price': None if tier is None else tariffs[tier][1],
+    }
+
+
+def quote_deliveries(longitudes, latitudes, pizzerias, tariffs=None):
+    """Quote delivery to many points at once.
+
+    Distances are spherical, which is within 0.6% of the geodesic
+    distance `quote_delivery` uses. Returns numpy arrays: position of
+    the closest pizzeria in `index.pizzerias`, distance in km, tier
+    and price, with tier and price set to -1 out of the zone.
+    """
+    tariffs = tariffs or delivery_settings['tariffs']
+    index = get_pizzeria_index(pizzerias)
+    positions, distances = index.nearest_many(longitudes, latitudes)
+    bounds = np.array([max_distance for max_distance, _ in tariffs])
+    prices = np.array([price for _, price in tariffs])
+    tiers = np.searchsorted(bounds, distances, side='left')
+    deliverable = distances < bounds[-1]
+    tiers = np.where(deliverable, tiers, -1)
+    return {
+        'index': index,
+        'pizzeria': positions,
+        'distance': distances,
+        'tier': tiers,
+        'price': np.where(deliverable, prices[np.clip(tiers, 0, None)], -1),
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Price delivery to addresses from csv with lon,lat.',
+    )
+    parser.add_argument('addresses', help='Csv file with lon,lat columns.')
+    parser.add_argument(
+        '--pizzerias',
+        help='Json with pizzeria entries, taken from moltin by default.',
+    )
+    parser.add_argument(
+        '--tariffs', default=os.getenv('DELIVERY_TARIFFS'),
+        help='Tariffs like 0.5:0,5:100,20:300.',
+    )
+    args = parser.parse_args()
+
+    if args.pizzerias:
+        with open(args.pizzerias) as file:
+            pizzerias = json.load(file)
+    else:
+        access_token = authenticate(
+            os.getenv('MOLTIN_CLIENT_ID'),
+            os.getenv('MOLTIN_CLIENT_SECRET'),
+        )['token']
+        pizzerias = get_all_pizzerias(access_token)
+    tariffs = parse_tariffs(args.tariffs) if args.tariffs else DEFAULT_TARIFFS
+
+    with open(args.addresses, newline='') as file:
+        rows = list(csv.DictReader(file))
+    quotes = quote_deliveries(
+        [row['lon'] for row in rows],
+        [row['lat'] for row in rows],
+        pizzerias,
+        tariffs,
+    )
+    pizzerias = quotes['index'].pizzerias
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['lon', 'lat', 'pizzeria', 'distance', 'tier', 'price'])
+    for row, position, distance, tier, price in zip(
+        rows, quotes['pizzeria'], quotes['distance'], quotes['tier'],
+        quotes['price'],
+    ):
+        writer.writerow([
+            row['lon'],
+            row['lat'],
+            pizzerias[position]['address'],
+            f'{distance:.3f}',
+            tier,
+            price,
+        ])
+
+
+if __name__ == '__main__':
+    main()
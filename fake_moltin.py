@@ -0,0 +1,362 @@
+"""Local stand-in for moltin api used by benchmarks and manual checks."""
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+def make_product(number):
+    product_id = f'product-{number}'
+    return {
+        'id': product_id,
+        'type': 'product',
+        'name': f'Пицца {number}',
+        'description': f'Описание пиццы {number}',
+        'price': [{'amount': 500 + number, 'currency': 'RUB'}],
+        'relationships': {
+            'main_image': {'data': {'type': 'main_image',
+                                    'id': f'file-{number}'}},
+        },
+    }
+
+
+class FakeMoltinState:
+    """In-memory store data served by fake moltin server."""
+
+    def __init__(self, products_count=10, base_url=''):
+        self.lock = threading.Lock()
+        self.products = {}
+        self.files = {}
+        self.carts = {}
+        self.customers = {}
+        self.flows = {}
+        self.fields = {}
+        self.entries = {}
+        for number in range(products_count):
+            product = make_product(number)
+            self.products[product['id']] = product
+            file_id = f'file-{number}'
+            self.files[file_id] = {
+                'id': file_id,
+                'type': 'file',
+                'link': {'href': f'{base_url}/files/{file_id}.jpg'},
+            }
+
+
+class FakeMoltinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.stats_lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith(
+                'application/json'):
+            return json.loads(body or b'{}')
+        return body
+
+    def handle_request(self, method):
+        with self.server.stats_lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = self.path.split('?')[0]
+        body = self.read_body() if method in ('POST', 'PUT') else None
+        for route_method, pattern, view in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                with self.server.state.lock:
+                    status, payload = view(
+                        self.server.state, body, self.path, *match.groups())
+                if isinstance(payload, bytes):
+                    self.send_response(status)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                else:
+                    self.send_json(payload, status)
+                return
+        self.send_json({'errors': [{'title': 'Not Found'}]}, 404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def cart_payload(state, cart_id):
+    items = state.carts.setdefault(cart_id, {})
+    total = sum(
+        item['value']['amount'] for item in items.values()
+    )
+    return {
+        'data': list(items.values()),
+        'meta': {'display_price': {'with_tax': {
+            'amount': total,
+            'formatted': f'{total} ₽',
+        }}},
+    }
+
+
+def view_token(state, body, full_path):
+    return 200, {
+        'access_token': uuid.uuid4().hex,
+        'expires': int(time.time()) + 3600,
+    }
+
+
+def get_page(items, full_path, field=None):
+    """Items passing `eq(field,value)` filter within page[] params."""
+    query = parse_qs(urlparse(full_path).query)
+    if field:
+        field_filter = re.fullmatch(
+            rf'eq\({field},(.*)\)', query.get('filter', [''])[0],
+        )
+        if field_filter:
+            items = [
+                item for item in items
+                if str(item.get(field)) == field_filter.group(1)
+            ]
+    if 'page[limit]' not in query:
+        return items
+    offset = int(query.get('page[offset]', ['0'])[0])
+    return items[offset:offset + int(query['page[limit]'][0])]
+
+
+def view_products(state, body, full_path):
+    return 200, {
+        'data': get_page(list(state.products.values()), full_path, 'sku'),
+    }
+
+
+def view_product(state, body, full_path, product_id):
+    if product_id not in state.products:
+        return 404, {'errors': [{'title': 'Not Found'}]}
+    return 200, {'data': state.products[product_id]}
+
+
+def view_file(state, body, full_path, file_id):
+    if file_id not in state.files:
+        return 404, {'errors': [{'title': 'Not Found'}]}
+    return 200, {'data': state.files[file_id]}
+
+
+def view_file_bytes(state, body, full_path, file_id):
+    return 200, file_id.encode() * 1024
+
+
+def view_cart(state, body, full_path, cart_id):
+    payload = cart_payload(state, cart_id)
+    return 200, {
+        'data': {'id': cart_id, 'type': 'cart',
+                 'meta': payload['meta']},
+    }
+
+
+def view_cart_items(state, body, full_path, cart_id):
+    return 200, cart_payload(state, cart_id)
+
+
+def view_add_to_cart(state, body, full_path, cart_id):
+    product = state.products[body['data']['id']]
+    quantity = body['data']['quantity']
+    items = state.carts.setdefault(cart_id, {})
+    item = items.get(product['id'])
+    if item:
+        quantity += item['quantity']
+    unit_price = product['price'][0]['amount']
+    items[product['id']] = {
+        'id': f'item-{product["id"]}',
+        'product_id': product['id'],
+        'type': 'cart_item',
+        'name': product['name'],
+        'description': product['description'],
+        'quantity': quantity,
+        'unit_price': {'amount': unit_price},
+        'value': {'amount': unit_price * quantity},
+    }
+    return 201, cart_payload(state, cart_id)
+
+
+def view_remove_from_cart(state, body, full_path, cart_id, item_id):
+    items = state.carts.setdefault(cart_id, {})
+    for product_id, item in list(items.items()):
+        if item['id'] == item_id:
+            del items[product_id]
+    return 200, cart_payload(state, cart_id)
+
+
+def view_customers(state, body, full_path):
+    customers = list(state.customers.values())
+    email_filter = re.search(r'filter=eq\(email,([^)]*)\)', unquote(full_path))
+    if email_filter:
+        customers = [
+            customer for customer in customers
+            if customer['email'].lower() == email_filter.group(1).lower()
+        ]
+    return 200, {'data': customers}
+
+
+def view_create_customer(state, body, full_path):
+    customer_id = uuid.uuid4().hex
+    customer = dict(body['data'], id=customer_id)
+    state.customers[customer_id] = customer
+    return 201, {'data': customer}
+
+
+def view_create_product(state, body, full_path):
+    product_id = uuid.uuid4().hex
+    product = dict(body['data'], id=product_id)
+    state.products[product_id] = product
+    return 201, {'data': product}
+
+
+def view_files(state, body, full_path):
+    return 200, {
+        'data': get_page(list(state.files.values()), full_path, 'file_name'),
+    }
+
+
+def view_create_file(state, body, full_path):
+    file_id = uuid.uuid4().hex
+    location = re.search(
+        rb'name="file_location"\r\n\r\n(.*?)\r\n', body, re.DOTALL,
+    )
+    file_name = ''
+    if location:
+        file_name = os.path.basename(
+            urlparse(location.group(1).decode()).path,
+        )
+    state.files[file_id] = {
+        'id': file_id, 'type': 'file', 'file_name': file_name,
+        'link': {'href': ''},
+    }
+    return 201, {'data': state.files[file_id]}
+
+
+def view_create_relationship(state, body, full_path, product_id):
+    state.products[product_id].setdefault('relationships', {})[
+        'main_image'] = {'data': body['data']}
+    return 201, {'data': body['data']}
+
+
+def view_create_flow(state, body, full_path):
+    flow_id = uuid.uuid4().hex
+    flow = dict(body['data'], id=flow_id)
+    state.flows[flow_id] = flow
+    state.entries.setdefault(flow['slug'], [])
+    return 201, {'data': flow}
+
+
+def view_flow(state, body, full_path, flow_id):
+    return 200, {'data': state.flows[flow_id]}
+
+
+def view_flows(state, body, full_path):
+    return 200, {'data': get_page(list(state.flows.values()), full_path)}
+
+
+def view_flow_fields(state, body, full_path, flow_slug):
+    flow_ids = {
+        flow['id'] for flow in state.flows.values()
+        if flow['slug'] == flow_slug
+    }
+    fields = [
+        field for field in state.fields.values()
+        if field['relationships']['flow']['data']['id'] in flow_ids
+    ]
+    return 200, {'data': get_page(fields, full_path)}
+
+
+def view_create_field(state, body, full_path):
+    field_id = uuid.uuid4().hex
+    state.fields[field_id] = dict(body['data'], id=field_id)
+    return 201, {'data': state.fields[field_id]}
+
+
+def view_entries(state, body, full_path, flow_slug):
+    return 200, {
+        'data': get_page(state.entries.get(flow_slug, []), full_path),
+    }
+
+
+def view_create_entry(state, body, full_path, flow_slug):
+    entry = dict(body['data'], id=uuid.uuid4().hex)
+    state.entries.setdefault(flow_slug, []).append(entry)
+    return 201, {'data': entry}
+
+
+ROUTES = (
+    ('POST', r'/oauth/access_token', view_token),
+    ('GET', r'/v2/products', view_products),
+    ('POST', r'/v2/products', view_create_product),
+    ('GET', r'/v2/products/([^/]+)', view_product),
+    ('POST', r'/v2/products/([^/]+)/relationships/main-image',
+     view_create_relationship),
+    ('GET', r'/v2/files', view_files),
+    ('GET', r'/v2/files/([^/]+)', view_file),
+    ('POST', r'/v2/files', view_create_file),
+    ('GET', r'/files/([^/]+)\.jpg', view_file_bytes),
+    ('GET', r'/v2/carts/([^/]+)', view_cart),
+    ('GET', r'/v2/carts/([^/]+)/items', view_cart_items),
+    ('POST', r'/v2/carts/([^/]+)/items', view_add_to_cart),
+    ('DELETE', r'/v2/carts/([^/]+)/items/([^/]+)', view_remove_from_cart),
+    ('GET', r'/v2/customers', view_customers),
+    ('POST', r'/v2/customers', view_create_customer),
+    ('GET', r'/v2/flows', view_flows),
+    ('POST', r'/v2/flows', view_create_flow),
+    ('GET', r'/v2/flows/([^/]+)', view_flow),
+    ('GET', r'/v2/flows/([^/]+)/fields', view_flow_fields),
+    ('POST', r'/v2/fields', view_create_field),
+    ('GET', r'/v2/flows/([^/]+)/entries', view_entries),
+    ('POST', r'/v2/flows/([^/]+)/entries', view_create_entry),
+)
+
+
+def start_server(host='127.0.0.1', port=0, latency=0, products_count=10):
+    """Start fake moltin server in a daemon thread."""
+    server = ThreadingHTTPServer((host, port), FakeMoltinHandler)
+    server.daemon_threads = True
+    server.url = f'http://{host}:{server.server_address[1]}'
+    server.state = FakeMoltinState(products_count, server.url)
+    server.latency = latency
+    server.stats_lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    server = start_server(port=8081)
+    print(f'Fake moltin is listening on {server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
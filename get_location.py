@@ -1,18 +1,81 @@
+import json
+import re
+import threading
+
+import numpy as np
 import requests
 
-from geopy import distance
+from cache import MISSING, TTLCache
+from circuit import breakers
+from metrics import track_upstream
+
+EARTH_RADIUS_KM = 6371.0088
+# Geodesic distance differs from the spherical one by less than 0.6%,
+# so candidates within this factor of the k-th spherical distance are
+# enough to find the k geodesically closest pizzerias.
+SPHERE_ERROR_FACTOR = 1.02
+
+GEOCODE_KEY_PREFIX = 'geocode:'
+GEOCODER_TIMEOUT = (3.05, 5)
+DEFAULT_GEOCODE_TTL = 30 * 24 * 60 * 60
+DEFAULT_GEOCODE_NEGATIVE_TTL = 24 * 60 * 60
+DEFAULT_GEOCODE_MEMORY_SIZE = 2048
+ADDRESS_ABBREVIATIONS = {
+    'улица': 'ул',
+    'проспект': 'пр-т',
+    'пр': 'пр-т',
+    'просп': 'пр-т',
+    'переулок': 'пер',
+    'площадь': 'пл',
+    'бульвар': 'б-р',
+    'бульв': 'б-р',
+    'шоссе': 'ш',
+    'набережная': 'наб',
+    'проезд': 'пр-д',
+    'город': 'г',
+    'дом': 'д',
+    'корпус': 'к',
+    'корп': 'к',
+    'строение': 'стр',
+}
+# Parts of address which do not change the building
+APARTMENT_PATTERN = re.compile(
+    r'\b(?:кв|квартира|под|подъезд|эт|этаж|офис|оф)\s*\d+\w*'
+)
+
+# geopy.distance, imported on first delivery quote, not at bot start
+distance = None
+
+_index_cache = {'pizzerias': None, 'fingerprint': None, 'index': None}
+_index_lock = threading.Lock()
+
+geocode_cache = TTLCache(
+    maxsize=DEFAULT_GEOCODE_MEMORY_SIZE,
+    ttl=DEFAULT_GEOCODE_NEGATIVE_TTL,
+)
+geocode_settings = {
+    'ttl': DEFAULT_GEOCODE_TTL,
+    'negative_ttl': DEFAULT_GEOCODE_NEGATIVE_TTL,
+}
+geocode_stats = {'redis_hits': 0, 'redis_misses': 0, 'not_found': 0}
+_stats_lock = threading.Lock()
 
 
 def get_coordinates(address, apikey):
-    response = requests.get(
-        "https://geocode-maps.yandex.ru/1.x",
-        params={
-            "geocode": address,
-            "apikey": apikey,
-            "format": "json",
-        }
-    )
-    response.raise_for_status()
+    def request():
+        with track_upstream('yandex_geocoder', 'GET /1.x'):
+            response = requests.get(
+                "https://geocode-maps.yandex.ru/1.x",
+                params={
+                    "geocode": address,
+                    "apikey": apikey,
+                    "format": "json",
+                },
+                timeout=GEOCODER_TIMEOUT,
+            )
+            response.raise_for_status()
+        return response
+    response = breakers.get('yandex_geocoder').call(request)
     found_places = response.json()['response']['GeoObjectCollection'][
         'featureMember'
     ]
@@ -26,31 +89,200 @@ def get_coordinates(address, apikey):
     return (lon, lat)
 
 
+def configure_geocode_cache(
+    ttl=DEFAULT_GEOCODE_TTL,
+    negative_ttl=DEFAULT_GEOCODE_NEGATIVE_TTL,
+    memory_size=DEFAULT_GEOCODE_MEMORY_SIZE,
+):
+    geocode_settings['ttl'] = ttl
+    geocode_settings['negative_ttl'] = negative_ttl
+    geocode_cache.maxsize = memory_size
+    geocode_cache.ttl = min(ttl, negative_ttl)
+    geocode_cache.invalidate()
+
+
+def normalize_address(address):
+    """Bring address to one spelling for use as a cache key."""
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[^\w/-]+', ' ', address)
+    address = re.sub(r'(?<=[^\W\d])(?=\d)', ' ', address)
+    address = APARTMENT_PATTERN.sub(' ', address)
+    words = [
+        ADDRESS_ABBREVIATIONS.get(word, word)
+        for word in address.split()
+    ]
+    return ' '.join(words)
+
+
+def count_geocode(stat):
+    with _stats_lock:
+        geocode_stats[stat] += 1
+
+
+def get_cached_coordinates(db, address, apikey):
+    """Geocode address through memory and redis caches."""
+    key = normalize_address(address)
+    coordinates = geocode_cache.get(key)
+    if coordinates is not MISSING:
+        return coordinates
+
+    cached = db.get(f'{GEOCODE_KEY_PREFIX}{key}')
+    if cached is not None:
+        count_geocode('redis_hits')
+        coordinates = json.loads(cached)
+        if coordinates:
+            coordinates = tuple(coordinates)
+            geocode_cache.set(key, coordinates, ttl=geocode_settings['ttl'])
+        else:
+            geocode_cache.set(key, coordinates)
+        return coordinates
+
+    count_geocode('redis_misses')
+    coordinates = get_coordinates(address, apikey)
+    if coordinates:
+        ttl = geocode_settings['ttl']
+    else:
+        count_geocode('not_found')
+        ttl = geocode_settings['negative_ttl']
+    db.set(f'{GEOCODE_KEY_PREFIX}{key}', json.dumps(coordinates), ex=ttl)
+    geocode_cache.set(key, coordinates, ttl=ttl)
+    return coordinates
+
+
+def get_geocode_stats():
+    memory_stats = geocode_cache.stats()
+    with _stats_lock:
+        stats = dict(geocode_stats)
+    lookups = memory_stats['hits'] + memory_stats['misses']
+    stats['memory_hits'] = memory_stats['hits']
+    stats['lookups'] = lookups
+    stats['hit_rate'] = (
+        (lookups - stats['redis_misses']) / lookups if lookups else 0
+    )
+    return stats
+
+
 def measure_distance(lon1, lat1, lon2, lat2):
+    global distance
+    if distance is None:
+        from geopy import distance
     return distance.distance((lat1, lon1), (lat2, lon2)).km
 
 
-def get_closest_pizzeria(coordinates, pizzerias):
-    customer_lon, customer_lat = coordinates
-    pizzerias_coords = []
-    for pizzeria in pizzerias:
-        address = pizzeria['address']
-        pizzeria_lon = pizzeria['longitude']
-        pizzeria_lat = pizzeria['latitude']
-        courier = pizzeria['telegram_id_01']
-        pizzerias_coords.append({
-            'address': address,
-            'longitude': pizzeria_lon,
-            'latitude': pizzeria_lat,
-            'courier': courier,
-            'distance': measure_distance(
+class PizzeriaIndex:
+    """Prebuilt coordinate arrays for nearest pizzeria queries."""
+
+    def __init__(self, pizzerias):
+        self.pizzerias = [
+            {
+                'address': pizzeria['address'],
+                'longitude': pizzeria['longitude'],
+                'latitude': pizzeria['latitude'],
+                'courier': pizzeria['telegram_id_01'],
+            }
+            for pizzeria in pizzerias
+        ]
+        self.longitudes = np.radians(np.array(
+            [pizzeria['longitude'] for pizzeria in self.pizzerias],
+            dtype=float,
+        ))
+        self.latitudes = np.radians(np.array(
+            [pizzeria['latitude'] for pizzeria in self.pizzerias],
+            dtype=float,
+        ))
+        self.latitudes_cos = np.cos(self.latitudes)
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def haversine(self, lon, lat):
+        """Spherical distances in km from point to every pizzeria."""
+        lon, lat = np.radians(float(lon)), np.radians(float(lat))
+        haversine = (
+            np.sin((self.latitudes - lat) / 2) ** 2
+            + np.cos(lat) * self.latitudes_cos
+            * np.sin((self.longitudes - lon) / 2) ** 2
+        )
+        return 2 * EARTH_RADIUS_KM * np.arcsin(
+            np.sqrt(np.clip(haversine, 0, 1)))
+
+    def nearest_many(self, longitudes, latitudes, chunk_size=None):
+        """Closest pizzeria position and spherical distance per point."""
+        longitudes = np.radians(np.asarray(longitudes, dtype=float))
+        latitudes = np.radians(np.asarray(latitudes, dtype=float))
+        if chunk_size is None:
+            chunk_size = max(1, 4_000_000 // max(len(self), 1))
+        positions = np.empty(len(longitudes), dtype=np.intp)
+        distances = np.empty(len(longitudes), dtype=float)
+        for start in range(0, len(longitudes), chunk_size):
+            stop = start + chunk_size
+            lon = longitudes[start:stop, np.newaxis]
+            lat = latitudes[start:stop, np.newaxis]
+            haversine = (
+                np.sin((self.latitudes - lat) / 2) ** 2
+                + np.cos(lat) * self.latitudes_cos
+                * np.sin((self.longitudes - lon) / 2) ** 2
+            )
+            closest = np.argmin(haversine, axis=1)
+            positions[start:stop] = closest
+            distances[start:stop] = 2 * EARTH_RADIUS_KM * np.arcsin(
+                np.sqrt(np.clip(
+                    haversine[np.arange(len(closest)), closest], 0, 1,
+                ))
+            )
+        return positions, distances
+
+    def nearest(self, coordinates, k=1):
+        """Return k closest pizzerias sorted by geodesic distance."""
+        customer_lon, customer_lat = coordinates
+        rough_distances = self.haversine(customer_lon, customer_lat)
+        k = min(k, len(self))
+        if len(self) > k:
+            kth_distance = np.partition(rough_distances, k - 1)[k - 1]
+            candidates = np.flatnonzero(
+                rough_distances <= kth_distance * SPHERE_ERROR_FACTOR + 1e-6
+            )
+        else:
+            candidates = np.arange(len(self))
+        closest = []
+        for position in candidates:
+            pizzeria = self.pizzerias[position]
+            closest.append(dict(pizzeria, distance=measure_distance(
                 customer_lon,
                 customer_lat,
-                pizzeria_lon,
-                pizzeria_lat,
-            ),
-        })
-
-    def get_distance(pizzeria):
-        return pizzeria['distance']
-    return min(pizzerias_coords, key=get_distance)
+                pizzeria['longitude'],
+                pizzeria['latitude'],
+            )))
+
+        def get_distance(pizzeria):
+            return pizzeria['distance']
+        return sorted(closest, key=get_distance)[:k]
+
+
+def get_pizzeria_index(pizzerias):
+    """Return index for pizzerias, rebuilding it only on changes."""
+    with _index_lock:
+        if _index_cache['pizzerias'] is pizzerias:
+            return _index_cache['index']
+        fingerprint = tuple(
+            (
+                pizzeria['address'],
+                pizzeria['longitude'],
+                pizzeria['latitude'],
+                pizzeria['telegram_id_01'],
+            )
+            for pizzeria in pizzerias
+        )
+        if fingerprint != _index_cache['fingerprint']:
+            _index_cache['index'] = PizzeriaIndex(pizzerias)
+            _index_cache['fingerprint'] = fingerprint
+        _index_cache['pizzerias'] = pizzerias
+        return _index_cache['index']
+
+
+def get_closest_pizzerias(coordinates, pizzerias, k):
+    return get_pizzeria_index(pizzerias).nearest(coordinates, k)
+
+
+def get_closest_pizzeria(coordinates, pizzerias):
+    return get_closest_pizzerias(coordinates, pizzerias, 1)[0]
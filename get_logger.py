@@ -1,14 +1,129 @@
 import logging
+import queue
+import threading
+import time
+from collections import Counter
+
+import telegram
+
+MESSAGE_LIMIT = 4096
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_DELAY = 1
+DEFAULT_MIN_INTERVAL = 3
+_STOP = object()
 
 
 class TelegramLogsHandler(logging.Handler):
-    """Logger handler class."""
+    """Logger handler class.
+
+    Records are queued and sent by a background thread, so logging
+    never waits for Telegram. Identical records arriving together are
+    sent once with a counter, several records share one message, and
+    messages go out no more often than once per `min_interval` seconds.
+    When the queue is full new records are dropped and counted.
+    """
 
-    def __init__(self, tg_bot, chat_id):
+    def __init__(self, tg_bot, chat_id, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_delay=DEFAULT_BATCH_DELAY,
+                 min_interval=DEFAULT_MIN_INTERVAL):
         super().__init__()
         self.chat_id = chat_id
         self.tg_bot = tg_bot
+        self.batch_delay = batch_delay
+        self.min_interval = min_interval
+        self.records = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.sent_messages = 0
+        self.failed_messages = 0
+        self._last_sent_at = 0
+        self._stats_lock = threading.Lock()
+        self._sender = threading.Thread(
+            target=self.run, name='telegram-logs', daemon=True,
+        )
+        self._sender.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.tg_bot.send_message(chat_id=self.chat_id, text=log_entry)
+        try:
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.records.put_nowait(log_entry)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+
+    def collect_batch(self, first_entry):
+        entries = [first_entry]
+        deadline = time.monotonic() + self.batch_delay
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self.records.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                self.records.put(_STOP)
+                break
+            entries.append(entry)
+        return entries
+
+    def build_messages(self, entries):
+        """Merge entries into as few messages as Telegram allows."""
+        with self._stats_lock:
+            dropped, self.dropped = self.dropped, 0
+        parts = []
+        if dropped:
+            parts.append(f'Пропущено записей лога: {dropped}')
+        for entry, count in Counter(entries).items():
+            if count > 1:
+                entry = f'{entry}\n(повторилось {count} раз)'
+            while len(entry) > MESSAGE_LIMIT:
+                parts.append(entry[:MESSAGE_LIMIT])
+                entry = entry[MESSAGE_LIMIT:]
+            parts.append(entry)
+
+        messages = []
+        message = ''
+        for part in parts:
+            if message and len(message) + len(part) + 2 > MESSAGE_LIMIT:
+                messages.append(message)
+                message = ''
+            message = f'{message}\n\n{part}' if message else part
+        if message:
+            messages.append(message)
+        return messages
+
+    def send(self, text):
+        delay = self._last_sent_at + self.min_interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+        except telegram.error.RetryAfter as error:
+            time.sleep(error.retry_after)
+            self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+        finally:
+            self._last_sent_at = time.monotonic()
+        self.sent_messages += 1
+
+    def run(self):
+        while True:
+            entry = self.records.get()
+            if entry is _STOP:
+                break
+            for text in self.build_messages(self.collect_batch(entry)):
+                try:
+                    self.send(text)
+                except Exception:
+                    self.failed_messages += 1
+
+    def close(self):
+        """Send what is queued and stop background thread."""
+        if self._sender.is_alive():
+            self.records.put(_STOP)
+            self._sender.join(timeout=10)
+        super().close()
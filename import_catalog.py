@@ -0,0 +1,241 @@
+"""Load menu and pizzeria addresses into moltin.
+
+Every api call has an idempotency key. Its result is written to a
+checkpoint file as soon as the call succeeds, so an interrupted import
+started again with the same checkpoint continues where it stopped.
+
+Moltin takes no idempotency key itself, so a crash after a create but
+before its checkpoint is saved would create the resource twice. When an
+import is resumed, the importer looks files, products, flows, fields and
+pizzerias up by file name, sku, slug or alias before creating them and
+records existing ones instead. Fields and pizzerias are listed once per
+import, page by page, rather than once per item.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+
+import store
+from store import (
+    PIZZERIAS_FLOW_SLUG, authenticate, create_entry, create_field,
+    create_file, create_flow, create_image_relationship, create_product,
+    find_file, find_flow, find_product, get_entry_ids, get_field_ids)
+
+DEFAULT_WORKERS = 8
+PIZZERIA_FIELDS = (
+    ('address', 'Адрес', 'string'),
+    ('alias', 'Псевдоним', 'string'),
+    ('longitude', 'Долгота', 'float'),
+    ('latitude', 'Широта', 'float'),
+    ('telegram_id_01', 'Telegram ID курьера', 'integer'),
+)
+
+
+class Checkpoint:
+    """Results of finished calls stored in a json file.
+
+    The file is written before the first call, so `resumed` tells an
+    import started again after a crash from a new one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        self._lock = threading.Lock()
+        self.resumed = os.path.exists(path)
+        if self.resumed:
+            with open(path) as file:
+                self.results = json.load(file)
+        else:
+            self.write()
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def save(self, key, value):
+        with self._lock:
+            self.results[key] = value
+            self.write()
+
+    def write(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.results, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+
+class Importer:
+    def __init__(self, access_token, checkpoint, workers=DEFAULT_WORKERS):
+        self.access_token = access_token
+        self.checkpoint = checkpoint
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.resumed = checkpoint.resumed
+        self.calls = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def step(self, key, create, *args, find=None):
+        """Call `create` once per idempotency key, return created id.
+
+        When the import is resumed `find` is called before `create`
+        and returns id of the resource if a previous run created it.
+        """
+        created_id = self.checkpoint.get(key)
+        if created_id is None and find is not None and self.resumed:
+            created_id = find()
+            if created_id is not None:
+                self.checkpoint.save(key, created_id)
+        if created_id is not None:
+            with self._lock:
+                self.skipped += 1
+            return created_id
+        created_id = create(self.access_token, *args)['data']['id']
+        self.checkpoint.save(key, created_id)
+        with self._lock:
+            self.calls += 1
+        return created_id
+
+    def run_all(self, function, items):
+        """Run function for every item concurrently, fail on any error."""
+        return list(self.executor.map(function, items))
+
+    def import_product(self, item):
+        item_id = item['id']
+        image_url = item['product_image']['url']
+        file_id = self.step(
+            f'file:{item_id}', create_file, image_url,
+            find=partial(
+                find_file,
+                os.path.basename(urlparse(image_url).path),
+                self.access_token,
+            ),
+        )
+        sku = str(item_id)
+        product_id = self.step(f'product:{item_id}', create_product, {
+            'type': 'product',
+            'name': item['name'],
+            'slug': f'pizza-{item_id}',
+            'sku': sku,
+            'description': item['description'],
+            'manage_stock': False,
+            'price': [{
+                'amount': item['price'],
+                'currency': 'RUB',
+                'includes_tax': True,
+            }],
+            'status': 'live',
+            'commodity_type': 'physical',
+        }, find=partial(find_product, sku, self.access_token))
+        self.step(
+            f'relationship:{item_id}',
+            create_image_relationship,
+            product_id,
+            file_id,
+        )
+
+    def import_menu(self, menu):
+        self.run_all(self.import_product, menu)
+
+    def import_pizzerias(self, addresses, courier_id,
+                         flow_slug=PIZZERIAS_FLOW_SLUG):
+        flow_id = self.step(
+            f'flow:{flow_slug}',
+            create_flow,
+            'Pizzeria',
+            flow_slug,
+            'Pizzeria addresses',
+            True,
+            find=partial(find_flow, flow_slug, self.access_token),
+        )
+        field_ids = {}
+        entry_ids = {}
+        if self.resumed:
+            field_ids = get_field_ids(flow_slug, self.access_token)
+            entry_ids = get_entry_ids(flow_slug, 'alias', self.access_token)
+
+        def create_pizzeria_field(field):
+            slug, name, field_type = field
+            self.step(
+                f'field:{flow_slug}:{slug}',
+                create_field,
+                name,
+                slug,
+                field_type,
+                name,
+                True,
+                True,
+                flow_id,
+                find=partial(field_ids.get, slug),
+            )
+        self.run_all(create_pizzeria_field, PIZZERIA_FIELDS)
+
+        def create_pizzeria(pizzeria):
+            self.step(
+                f'entry:{flow_slug}:{pizzeria["id"]}',
+                create_entry,
+                flow_slug,
+                {
+                    'address': pizzeria['address']['full'],
+                    'alias': pizzeria['alias'],
+                    'longitude': float(pizzeria['coordinates']['lon']),
+                    'latitude': float(pizzeria['coordinates']['lat']),
+                    'telegram_id_01': courier_id,
+                },
+                find=partial(entry_ids.get, pizzeria['alias']),
+            )
+        self.run_all(create_pizzeria, addresses)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Import menu and pizzerias into moltin.',
+    )
+    parser.add_argument('--menu', help='Path to menu json.')
+    parser.add_argument('--addresses', help='Path to pizzerias json.')
+    parser.add_argument(
+        '--courier-id', type=int,
+        default=os.getenv('TELEGRAM_CHAT_ID'),
+        help='Telegram id of courier for imported pizzerias.',
+    )
+    parser.add_argument(
+        '--checkpoint', default='import_checkpoint.json',
+        help='File with results of finished calls.',
+    )
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--base-url', default=store.MOLTIN_API_URL)
+    args = parser.parse_args()
+
+    store.configure_client(base_url=args.base_url, pool_size=args.workers)
+    access_token = authenticate(
+        os.getenv('MOLTIN_CLIENT_ID'),
+        os.getenv('MOLTIN_CLIENT_SECRET'),
+    )['token']
+    importer = Importer(
+        access_token, Checkpoint(args.checkpoint), args.workers,
+    )
+
+    started_at = time.perf_counter()
+    if args.menu:
+        with open(args.menu) as file:
+            importer.import_menu(json.load(file))
+    if args.addresses:
+        with open(args.addresses) as file:
+            importer.import_pizzerias(json.load(file), args.courier_id)
+    elapsed = time.perf_counter() - started_at
+    print(
+        f'{importer.calls} calls in {elapsed:.1f} s, '
+        f'{importer.calls / elapsed if elapsed else 0:.1f} calls/s, '
+        f'{importer.skipped} skipped as already done'
+    )
+
+
+if __name__ == '__main__':
+    main()
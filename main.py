@@ -1,49 +1,101 @@
 import logging
 import os
+import queue
+import signal
 import textwrap
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
 
-import redis
+import requests
 import telegram
 from dotenv import load_dotenv
-from email_validator import (EmailNotValidError, EmailSyntaxError,
-                             validate_email)
 from telegram import (
     InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, Update)
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
-                          CommandHandler, Filters, MessageHandler, Updater)
+                          CommandHandler, DispatcherHandlerStop, Filters,
+                          MessageHandler, TypeHandler, Updater)
 
-from get_location import get_closest_pizzeria, get_coordinates
+import async_store
+import chat_dispatch
+import outbox
+import scheduler
+import store
+from cache import RedisCacheTier
+from cart_mirror import (
+    DEFAULT_CART_MIRROR_TTL, add_cart_item, configure_cart_mirror,
+    get_cart_total, get_mirrored_cart_items, remove_cart_item,
+    save_cart_items)
+from chat_dispatch import (
+    DEFAULT_CHAT_WORKERS, dispatch_by_chat, start_chat_executor)
+from circuit import (
+    DEFAULT_FAILURE_THRESHOLD, DEFAULT_LATENCY_BUDGET, DEFAULT_RESET_TIMEOUT,
+    CircuitOpenError, breakers)
+from customers import get_or_create_customer
+from delivery import configure_tariffs, parse_tariffs, quote_delivery
+from get_location import (
+    DEFAULT_GEOCODE_MEMORY_SIZE, DEFAULT_GEOCODE_NEGATIVE_TTL,
+    DEFAULT_GEOCODE_TTL, configure_geocode_cache, get_cached_coordinates,
+    get_geocode_stats, get_pizzeria_index)
 from get_logger import TelegramLogsHandler
+from menu import (
+    DEFAULT_PAGE_SIZE, configure_menu, get_menu_page, parse_page_callback)
+from metrics import (
+    InstrumentedRequest, start_metrics_server, state_duration,
+    state_errors_total, updates_total)
+from outbox import (
+    DEFAULT_CHAT_BURST, DEFAULT_CHAT_RATE, DEFAULT_GLOBAL_RATE,
+    DEFAULT_SENDER_WORKERS, PRIORITY_COURIER, PRIORITY_NOTIFICATION, send,
+    start_outbox)
+from photos import (
+    DEFAULT_PHOTO_CACHE_BYTES, DEFAULT_PHOTO_CACHE_DIR, configure_photo_cache,
+    forget_photo_id, get_product_photo, load_photo_ids, remember_photo_id)
+from profiling import DEFAULT_INTERVAL as DEFAULT_PROFILE_INTERVAL
+from profiling import DEFAULT_RATE as DEFAULT_PROFILE_RATE
+from profiling import MODES as PROFILE_MODES
+from profiling import parse_targets, profiler
+from rate_limit import RedisTokenBucket
+from scheduler import DEFAULT_LEASE, DEFAULT_POLL_INTERVAL, start_job_queue
+from session import (
+    DEFAULT_MAX_CONNECTIONS, DEFAULT_SOCKET_TIMEOUT, ChatSession, create_redis)
 from store import (
-    add_to_cart, authenticate, check_customer, create_customer, create_entry,
-    get_all_pizzerias, get_all_products, get_cart, get_cart_items, get_file,
-    get_photo, get_product, remove_product_from_cart)
+    DEFAULT_CATALOG_CACHE_SIZE, DEFAULT_CATALOG_CACHE_TTL,
+    DEFAULT_CATALOG_STALE_TTL, DEFAULT_MAX_RETRIES, DEFAULT_POOL_SIZE,
+    DEFAULT_TIMEOUT, catalog_cache, configure_catalog_cache,
+    configure_client, get_all_pizzerias, get_all_products, get_product)
+from tokens import DEFAULT_REFRESH_MARGIN, get_token, start_token_provider
+from warmup import DEFAULT_WARMUP_TIMEOUT, warm_up
+from webhook import run_webhook
+
+DEFAULT_WORKERS = 4
+MOLTIN_RATE_LIMIT_KEY = 'moltin_rate_limit'
+TELEGRAM_RATE_LIMIT_KEY = 'telegram_rate_limit'
+OUTBOX_DRAIN_TIMEOUT = 10
+HEARTBEAT_INTERVAL = 1
+CATALOG_SHARED_KEY = 'catalog_cache'
+PROFILE_RATE_OPTION = 'rate='
+DEFAULT_WEBHOOK_PORT = 8443
+PHOTO_RESEND_WORKERS = 2
 
 logger = logging.getLogger('Logger')
+supervisor_pid = None
+# Photos rejected by file id are sent again here, not in outbox senders
+photo_resend_executor = ThreadPoolExecutor(
+    max_workers=PHOTO_RESEND_WORKERS, thread_name_prefix='photo-resend',
+)
 
 
-def get_product_keyboard(products):
-    keyboard = []
-    for product in products:
-        button = [
-            InlineKeyboardButton(
-                product['name'],
-                callback_data=product['id'],
-            )
-        ]
-        keyboard.append(button)
-    keyboard.append([InlineKeyboardButton(
-        'Корзина', callback_data='cart')])
-    return InlineKeyboardMarkup(keyboard)
+def get_product_keyboard(products, page=0):
+    return get_menu_page(products, page)
 
 
 def start(db, update: Update, context: CallbackContext, job_queue):
     """Start bot."""
-    products = get_all_products(db.get('token').decode("utf-8"))
+    products = get_all_products(get_token())
     reply_markup = get_product_keyboard(products)
-    context.bot.send_message(
+    send(
+        context.bot, 'send_message',
         chat_id=update.effective_chat.id,
         text='Пожалуйста, выберите:',
         reply_markup=reply_markup,
@@ -51,9 +103,69 @@ def start(db, update: Update, context: CallbackContext, job_queue):
     return "HANDLE_MENU"
 
 
+def send_product_photo(db, bot, chat_id, image_id, caption, reply_markup):
+    """Send product photo by telegram file id, if there is one.
+
+    A file id that telegram no longer accepts is forgotten and the
+    photo is sent again as a file from `photo_resend_executor`, since
+    the check runs in an outbox sender thread; the new file id is
+    remembered.
+    """
+    photo = get_product_photo(db, image_id, get_token())
+
+    def on_sent(future):
+        error = future.exception()
+        if error is None:
+            remember_photo_id(
+                db, image_id, future.result().photo[-1].file_id,
+            )
+        elif (
+            isinstance(error, telegram.error.BadRequest)
+            and not isinstance(photo, bytes)
+        ):
+            forget_photo_id(db, image_id)
+            photo_resend_executor.submit(
+                resend_product_photo,
+                db, bot, chat_id, image_id, caption, reply_markup,
+            )
+
+    try:
+        future = send(
+            bot, 'send_photo',
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+    except telegram.error.BadRequest as error:
+        if isinstance(photo, bytes):
+            raise
+        future = Future()
+        future.set_exception(error)
+    future.add_done_callback(on_sent)
+
+
+def resend_product_photo(db, bot, chat_id, image_id, caption, reply_markup):
+    try:
+        send_product_photo(db, bot, chat_id, image_id, caption, reply_markup)
+    except Exception:
+        logger.exception(f'Sending photo {image_id} again failed')
+
+
 def handle_menu(db, update: Update, context: CallbackContext, job_queue):
     """Handle menu."""
-    context.bot.delete_message(
+    page = parse_page_callback(update.callback_query.data)
+    if page is not None:
+        products = get_all_products(get_token())
+        send(
+            context.bot, 'edit_message_reply_markup',
+            chat_id=update.effective_chat.id,
+            message_id=update.callback_query.message.message_id,
+            reply_markup=get_product_keyboard(products, page),
+        )
+        return 'HANDLE_MENU'
+    send(
+        context.bot, 'delete_message',
         chat_id=update.effective_chat.id,
         message_id=update.callback_query.message.message_id,
     )
@@ -62,19 +174,16 @@ def handle_menu(db, update: Update, context: CallbackContext, job_queue):
         client_id = update.effective_chat.id
         text, keyboard = get_customer_cart(db, client_id)
         reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=''.join(text),
             reply_markup=reply_markup,
         )
         return 'HANDLE_CART'
     product_id = callback
-    product = get_product(product_id, db.get('token').decode("utf-8"))
-    file = get_file(
-        file_id=product['relationships']['main_image']['data']['id'],
-        access_token=db.get('token').decode("utf-8"),
-    )
-    photo = get_photo(link=file['link']['href'])
+    product = get_product(product_id, get_token())
+    image_id = product['relationships']['main_image']['data']['id']
     name = product['name']
     price = product['price'][0]['amount']
     description = product['description']
@@ -90,9 +199,11 @@ def handle_menu(db, update: Update, context: CallbackContext, job_queue):
             [InlineKeyboardButton('Назад', callback_data='back')]]
     )
 
-    context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=photo,
+    send_product_photo(
+        db,
+        context.bot,
+        update.effective_chat.id,
+        image_id,
         caption=text,
         reply_markup=reply_markup,
     )
@@ -100,10 +211,12 @@ def handle_menu(db, update: Update, context: CallbackContext, job_queue):
 
 
 def get_customer_cart(db, client_id):
-    cart_items = get_cart_items(client_id, db.get('token').decode("utf-8"))
-    cart_payload = get_cart(client_id, db.get('token').decode("utf-8"))
-    grand_total = cart_payload[
-        'meta']['display_price']['with_tax']['formatted']
+    cart_items = get_mirrored_cart_items(db, client_id, get_token())
+    return format_customer_cart(cart_items)
+
+
+def format_customer_cart(cart_items):
+    grand_total = f'{get_cart_total(cart_items)} руб.'
     amount = 0
     text = []
     keyboard = []
@@ -143,7 +256,8 @@ def handle_description(
         client_id = update.effective_chat.id
         text, keyboard = get_customer_cart(db, client_id)
         reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=''.join(text),
             reply_markup=reply_markup,
@@ -152,17 +266,19 @@ def handle_description(
     elif callback != 'back':
         quantity, product_id = callback.split(',')
         client_id = update.effective_chat.id
-        add_to_cart(client_id, product_id,
-                    int(quantity), db.get('token').decode("utf-8"))
+        add_cart_item(db, client_id, product_id,
+                      int(quantity), get_token())
         return "HANDLE_DESCRIPTION"
     else:
-        context.bot.delete_message(
+        send(
+            context.bot, 'delete_message',
             chat_id=update.effective_chat.id,
             message_id=update.callback_query.message.message_id,
         )
-        products = get_all_products(db.get('token').decode("utf-8"))
+        products = get_all_products(get_token())
         reply_markup = get_product_keyboard(products)
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text='Please choose:',
             reply_markup=reply_markup,
@@ -174,68 +290,62 @@ def handle_cart(db, update: Update, context: CallbackContext, job_queue):
     """Handle user cart."""
     callback = update.callback_query.data
     if callback == 'back':
-        products = get_all_products(db.get('token').decode("utf-8"))
-        keyboard = []
-        for product in products:
-            button = [
-                InlineKeyboardButton(
-                    product['name'],
-                    callback_data=product['id'],
-                )
-            ]
-            keyboard.append(button)
-        keyboard.append([InlineKeyboardButton(
-            'Корзина', callback_data='cart')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(
+        products = get_all_products(get_token())
+        reply_markup = get_product_keyboard(products)
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text='Пожалуйста, выберите:',
             reply_markup=reply_markup,
         )
         return "HANDLE_MENU"
     elif callback == 'pay':
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text='Пожалуйста, укажите Вашу почту:',
         )
         return 'OBTAIN_EMAIL'
     else:
-        remove_product_from_cart(
-            product_id=callback,
-            cart_id=update.effective_chat.id,
-            access_token=db.get('token').decode("utf-8"),
+        remove_cart_item(
+            db,
+            client_id=update.effective_chat.id,
+            item_id=callback,
+            access_token=get_token(),
         )
         return 'HANDLE_CART'
 
 
 def obtain_email(db, update: Update, context: CallbackContext, job_queue):
     """Get user email."""
+    # email_validator loads a dns resolver, so it is imported on first
+    # use instead of at bot start
+    from email_validator import EmailNotValidError, validate_email
     email = update.message.text
     try:
         email = validate_email(email, timeout=5).email
         text = f'Вы прислали мне эту почту: {email}'
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=text,
         )
-        customer_id = check_customer(
-            email=email,
-            access_token=db.get('token').decode("utf-8")
-        )
-        if not customer_id:
-            create_customer(email, db.get('token').decode("utf-8"))
+        get_or_create_customer(db, email, get_token())
         text = 'Хорошо, пришлите нам ваш адрес текстом или геолокацию.'
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=text,
         )
         return 'OBTAIN_GEOLOCATION'
-    except (EmailSyntaxError, EmailNotValidError) as text:
-        context.bot.send_message(
+    except EmailNotValidError as text:
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=str(text),
         )
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text='Пожалуйста, укажите Вашу почту:',
         )
@@ -257,17 +367,30 @@ def obtain_geolocation(
     if message.location:
         current_pos = (message.location.latitude, message.location.longitude)
     else:
-        current_pos = get_coordinates(
-            message.text, db.get('yandex_key').decode("utf-8"),
-        )
+        try:
+            current_pos = get_cached_coordinates(
+                db, message.text, os.getenv('YANDEX_KEY'),
+            )
+        except (CircuitOpenError, requests.RequestException):
+            logger.warning('Geocoder is unavailable', exc_info=True)
+            send(
+                context.bot, 'send_message',
+                chat_id=update.effective_chat.id,
+                text=(
+                    'Сейчас не получается найти адрес. '
+                    'Пришлите, пожалуйста, геолокацию.'
+                ),
+            )
+            return 'OBTAIN_GEOLOCATION'
     if current_pos:
         pizzerias = get_all_pizzerias(
-            access_token=db.get('token').decode("utf-8"),
+            access_token=get_token(),
         )
-        pizzeria = get_closest_pizzeria(current_pos, pizzerias)
-        address = pizzeria['address']
-        distance = pizzeria['distance']
-        courier = pizzeria['courier']
+        quote = quote_delivery(current_pos, pizzerias)
+        address = quote['pizzeria']['address']
+        distance = quote['distance']
+        courier = quote['pizzeria']['courier']
+        delivery_price = quote['price']
 
         keyboard = [
             [InlineKeyboardButton(
@@ -278,14 +401,8 @@ def obtain_geolocation(
 
         lat, lon = current_pos
 
-        if 0 <= distance < 20:
-            if distance <= 0.5:
-                delivery_price = 0
-            elif distance <= 5:
-                delivery_price = 100
-            else:
-                delivery_price = 300
-            if distance <= 0.5:
+        if delivery_price is not None:
+            if delivery_price == 0:
                 distance = distance / 1000
                 message = textwrap.dedent(
                     f'''
@@ -312,14 +429,16 @@ def obtain_geolocation(
                 Простите, но так далеко мы пиццу не доставим.
                 Ближайшая пиццерия аж в {distance:.1f} километрах от вас!
                 ''')
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=f'{message}',
             reply_markup=InlineKeyboardMarkup(keyboard),
         )
         return 'HANDLE_DELIVERY'
     else:
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text='Не могу распознать адрес.',
         )
@@ -327,12 +446,16 @@ def obtain_geolocation(
 
 
 def send_message_to_courier(context, lat, lon, message, courier_id):
-    context.bot.send_message(
+    send(
+        context.bot, 'send_message',
         chat_id=courier_id,
+        priority=PRIORITY_COURIER,
         text=message,
     )
-    context.bot.send_location(
+    send(
+        context.bot, 'send_location',
         chat_id=courier_id,
+        priority=PRIORITY_COURIER,
         latitude=lat,
         longitude=lon,
     )
@@ -347,47 +470,64 @@ def notify_of_delay(context):
     )
     message = f'Приятного аппетита! {ad}\
                \n{delay_message}'
-    context.bot.send_message(
+    return send(
+        context.bot, 'send_message',
         chat_id=context.job.context,
+        priority=PRIORITY_NOTIFICATION,
         text=message
     )
 
 
+def parse_delivery_callback(data):
+    """Split `pickup;address` or `delivery;lat;lon;courier;price`."""
+    kind, _, payload = data.partition(';')
+    if kind == 'pickup':
+        return kind, (payload,)
+    return kind, tuple(payload.split(';'))
+
+
 def handle_delivery(db, update: Update, context: CallbackContext, job_queue):
     """Handle delivery choice."""
-    callback = update.callback_query.data.split(';')
-    if callback[0] == 'pickup':
-        address = callback[1]
+    kind, fields = parse_delivery_callback(update.callback_query.data)
+    if kind == 'pickup':
+        address, = fields
         message = textwrap.dedent(
             f'''
             Вот адрес ближайшей пиццерии: {address}.
             Будем Вас ждать!
             '''
         )
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text=message,
         )
         return 'START'
-    elif callback[0] == 'delivery':
+    elif kind == 'delivery':
         client_id = update.effective_chat.id
-        context.bot.send_message(
+        send(
+            context.bot, 'send_message',
             chat_id=update.effective_chat.id,
             text='Отправляем счет на оплату',
         )
-        _, lat, lon, courier, delivery_price = callback
+        lat, lon, courier, delivery_price = fields
 
         fields_values = {
             'latitude_01': float(lat),
             'longitude_01': float(lon),
             'customer_id_01': update.effective_chat.id,
         }
-        create_entry(
-            access_token=db.get('token').decode("utf-8"),
-            flow_slug='customer_address_01',
-            field_values=fields_values
+        access_token = get_token()
+        _, cart_items = async_store.gather(
+            async_store.create_entry(
+                access_token=access_token,
+                flow_slug='customer_address_01',
+                field_values=fields_values
+            ),
+            async_store.get_cart_items(client_id, access_token),
         )
-        text, _ = get_customer_cart(db, update.effective_chat.id)
+        save_cart_items(db, client_id, cart_items)
+        text, _ = format_customer_cart(cart_items)
         send_message_to_courier(
             context=context,
             lat=lat,
@@ -396,7 +536,6 @@ def handle_delivery(db, update: Update, context: CallbackContext, job_queue):
             courier_id=courier,
         )
 
-        cart_items = get_cart_items(client_id, db.get('token').decode("utf-8"))
         prices = []
         minimum_price = 100
         for item in cart_items:
@@ -409,7 +548,8 @@ def handle_delivery(db, update: Update, context: CallbackContext, job_queue):
             label='Досткавка',
             amount=int(delivery_price)*minimum_price,
         ))
-        context.bot.send_invoice(
+        send(
+            context.bot, 'send_invoice',
             chat_id=update.effective_chat.id,
             title='Ваш заказ',
             description='Pizza delivery',
@@ -435,7 +575,8 @@ def handle_payment(
         Ожидайте доставку.
         '''
     )
-    context.bot.send_message(
+    send(
+        context.bot, 'send_message',
         chat_id=update.effective_chat.id,
         text=message,
     )
@@ -460,10 +601,11 @@ def handle_users_reply(
         chat_id = update.callback_query.message.chat_id
     else:
         return
+    session = ChatSession.load(db, chat_id)
     if user_reply == '/start':
         user_state = 'START'
     else:
-        user_state = db.get(chat_id).decode("utf-8")
+        user_state = session.state or 'START'
 
     states_functions = {
         'START': start,
@@ -476,59 +618,395 @@ def handle_users_reply(
         'HANDLE_PAYMENT': handle_payment,
     }
     state_handler = states_functions[user_state]
-    expiration = int(db.get('token_expiration').decode("utf-8"))
-    if expiration < time.time():
-        moltin_token = authenticate(
-            os.getenv('MOLTIN_CLIENT_ID'),
-            os.getenv('MOLTIN_CLIENT_SECRET')
+    updates_total.inc(user_state)
+    started_at = time.perf_counter()
+    try:
+        if profiler.active:
+            with profiler.capture(user_state, chat_id):
+                next_state = state_handler(db, update, context, job_queue)
+        else:
+            next_state = state_handler(db, update, context, job_queue)
+    except Exception as error:
+        state_errors_total.inc(user_state, type(error).__name__)
+        raise
+    finally:
+        state_duration.observe(time.perf_counter() - started_at, user_state)
+    session.state = next_state
+    session.save()
+
+
+def refresh_catalog(update: Update, context: CallbackContext):
+    """Drop cached catalog on admin request, in every worker."""
+    catalog_cache.invalidate()
+    if supervisor_pid:
+        os.kill(supervisor_pid, signal.SIGHUP)
+    context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text='Каталог будет загружен заново.',
+    )
+
+
+def show_stats(update: Update, context: CallbackContext):
+    """Send cache statistics to admin."""
+    stats = catalog_cache.stats()
+    geocode_stats = get_geocode_stats()
+    text = textwrap.dedent(
+        f'''
+        Кэш каталога: {stats['size']} записей, версия {stats['version']}
+        Попаданий: {stats['hits']}, промахов: {stats['misses']}
+        Доля попаданий: {stats['hit_rate']:.0%}
+        Устаревших ответов: {stats['stale_hits']}
+        Недоступно: {', '.join(breakers.get_open()) or 'ничего'}
+
+        Геокодер: {geocode_stats['lookups']} запросов
+        Из памяти: {geocode_stats['memory_hits']}
+        Из Redis: {geocode_stats['redis_hits']}
+        Из Яндекса: {geocode_stats['redis_misses']}
+        Адрес не найден: {geocode_stats['not_found']}
+        Доля попаданий: {geocode_stats['hit_rate']:.0%}
+        '''
+    )
+    request_stats = store.client.stats.snapshot()
+    async_request_stats = async_store.client.stats.snapshot()
+    for name, count in async_request_stats.items():
+        request_stats[name] += count
+    text += textwrap.dedent(
+        f'''
+        Запросов к Moltin: {request_stats['requests']}
+        Ответов 429: {request_stats['throttled']}
+        Повторов: {request_stats['retried']}
+        Ожиданий лимита: {request_stats['budget_waits']}
+        '''
+    )
+    if outbox.outbox:
+        outbox_stats = outbox.outbox.stats()
+        text += textwrap.dedent(
+            f'''
+            Исходящих в очереди: {outbox_stats['pending']}
+            Отправлено: {outbox_stats['sent']}, склеено: {outbox_stats['merged']}
+            Ожиданий flood wait: {outbox_stats['flood_waits']}
+            Ошибок отправки: {outbox_stats['failed']}
+            '''
+        )
+    if scheduler.job_queue:
+        text += f'\nОтложенных уведомлений: {scheduler.job_queue.pending()}\n'
+    if chat_dispatch.chat_executor:
+        dispatch_stats = chat_dispatch.chat_executor.stats()
+        text += textwrap.dedent(
+            f'''
+            Обработчики: {dispatch_stats['workers']} потоков
+            Чатов в работе: {dispatch_stats['active_chats']}
+            Обновлений в очередях: {dispatch_stats['queued_updates']}
+            Самая длинная очередь: {dispatch_stats['max_queue_depth']}
+            Без чата в работе: {dispatch_stats['running_without_chat']}
+            Рекорд с запуска: {dispatch_stats['max_queue_depth_seen']}
+            Обработано обновлений: {dispatch_stats['processed']}
+            '''
         )
-        db.set('token', moltin_token['token'])
-        db.set('token_expiration', moltin_token['expires'])
-        logger.error('Token updated')
-    next_state = state_handler(db, update, context, job_queue)
-    db.set(chat_id, next_state)
+    context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=text,
+    )
+
+
+def configure_profiler(update: Update, context: CallbackContext):
+    """Switch profiling on admin request.
+
+    `/profile` shows settings, `/profile off` turns profiling off,
+    `/profile stack rate=0.1 OBTAIN_GEOLOCATION 12345` profiles a tenth
+    of updates in the state or the chat with stack sampling.
+    """
+    args = context.args
+    if args and args[0] == 'off':
+        profiler.disable()
+    elif args:
+        mode, *targets = args
+        rate = DEFAULT_PROFILE_RATE
+        try:
+            if targets and targets[0].startswith(PROFILE_RATE_OPTION):
+                rate = float(targets.pop(0)[len(PROFILE_RATE_OPTION):])
+            states, chat_ids = parse_targets(targets)
+            profiler.configure(
+                mode, rate, states, chat_ids, interval=profiler.interval,
+            )
+        except ValueError:
+            context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text=(
+                    f'Формат: /profile {"|".join(PROFILE_MODES)} '
+                    f'[{PROFILE_RATE_OPTION}доля от 0 до 1] '
+                    f'[состояния и номера чатов]'
+                ),
+            )
+            return
+    context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=profiler.describe(),
+    )
+
+
+def invalidate_catalog_on_signal(signum, frame):
+    catalog_cache.invalidate()
+    logger.warning('Catalog cache invalidated by signal')
 
 
 def error_handler(update: Update, context: CallbackContext):
-    """Handle errors."""
+    """Handle errors and tell the user their message was not handled."""
     logger.error(msg="Телеграм бот упал с ошибкой:", exc_info=context.error)
+    if not isinstance(update, Update) or not update.effective_chat:
+        return
+    if isinstance(context.error, CircuitOpenError):
+        text = 'Сервис временно недоступен. Попробуйте ещё раз через минуту.'
+    else:
+        text = 'Что-то пошло не так. Попробуйте ещё раз или отправьте /start.'
+    try:
+        send(
+            context.bot, 'send_message',
+            chat_id=update.effective_chat.id,
+            text=text,
+        )
+    except telegram.error.TelegramError:
+        logger.warning('Could not tell user about error', exc_info=True)
 
 
-def main():
-    """Main function."""
+def warm_up_catalog():
+    """Load products, their cards and images into catalog cache."""
+    access_token = get_token()
+    products = get_all_products(access_token)
+    image_ids = {
+        product['relationships']['main_image']['data']['id']
+        for product in products
+        if product.get('relationships', {}).get('main_image')
+    }
+    async_store.gather(
+        *(
+            async_store.get_product(product['id'], access_token)
+            for product in products
+        ),
+        *(
+            async_store.get_file(image_id, access_token)
+            for image_id in image_ids
+        ),
+    )
+
+
+def warm_up_pizzerias():
+    get_pizzeria_index(get_all_pizzerias(get_token()))
+
+
+def get_warm_up_tasks(db):
+    return {
+        'moltin token': get_token,
+        'catalog': warm_up_catalog,
+        'pizzerias': warm_up_pizzerias,
+        'photo ids': partial(load_photo_ids, db),
+    }
+
+
+def report_started(on_ready=None):
+    logger.warning(
+        f'Pizza бот запущен, кэши прогреты за {warm_up.elapsed:.1f} с'
+    )
+    if on_ready:
+        on_ready()
+
+
+def create_updater(worker_number=0, on_ready=None):
+    """Configure bot from environment, return updater with handlers.
+
+    Every worker of the supervisor serves metrics on its own port,
+    METRICS_PORT plus its number. Caches are warmed up in background,
+    `on_ready` is called when they are.
+    """
     load_dotenv()
     logger_bot_token = os.getenv('LOGGER_BOT_TOKEN')
     chat_id = os.getenv('TELEGRAM_CHAT_ID')
 
     logger_bot = telegram.Bot(logger_bot_token)
     logger.addHandler(TelegramLogsHandler(logger_bot, chat_id))
-    logger.warning("Pizza бот запущен")
+
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        start_metrics_server(
+            os.getenv('METRICS_LISTEN', '0.0.0.0'),
+            int(metrics_port) + worker_number,
+        )
+    profile_mode = os.getenv('PROFILE_MODE')
+    if profile_mode:
+        states, chat_ids = parse_targets(
+            os.getenv('PROFILE_TARGETS', '').split(),
+        )
+        profiler.configure(
+            profile_mode,
+            rate=float(os.getenv('PROFILE_RATE', DEFAULT_PROFILE_RATE)),
+            states=states,
+            chat_ids=chat_ids,
+            interval=float(os.getenv(
+                'PROFILE_INTERVAL', DEFAULT_PROFILE_INTERVAL,
+            )),
+            directory=os.getenv('PROFILE_DIR'),
+        )
 
     database_password = os.getenv("DATABASE_PASSWORD")
     database_host = os.getenv("DATABASE_HOST")
     database_port = os.getenv("DATABASE_PORT")
-    db = redis.Redis(
+    db = create_redis(
         host=database_host,
         port=database_port,
-        password=database_password
+        password=database_password,
+        max_connections=int(os.getenv(
+            'DATABASE_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS,
+        )),
+        socket_timeout=float(os.getenv(
+            'DATABASE_SOCKET_TIMEOUT', DEFAULT_SOCKET_TIMEOUT,
+        )),
     )
 
-    moltin_token = authenticate(
+    moltin_timeout = os.getenv('MOLTIN_TIMEOUT')
+    moltin_rate_limit = os.getenv('MOLTIN_RATE_LIMIT')
+    moltin_rate_burst = os.getenv('MOLTIN_RATE_BURST')
+    rate_limiter = None
+    if moltin_rate_limit:
+        rate_limiter = RedisTokenBucket(
+            db,
+            MOLTIN_RATE_LIMIT_KEY,
+            rate=float(moltin_rate_limit),
+            capacity=float(moltin_rate_burst) if moltin_rate_burst else None,
+        )
+    max_retries = int(os.getenv('MOLTIN_MAX_RETRIES', DEFAULT_MAX_RETRIES))
+    configure_client(
+        pool_size=int(os.getenv('MOLTIN_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        timeout=float(moltin_timeout) if moltin_timeout else DEFAULT_TIMEOUT,
+        rate_limiter=rate_limiter,
+        max_retries=max_retries,
+    )
+    async_store.configure_client(
+        pool_size=int(os.getenv('MOLTIN_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        timeout=float(moltin_timeout) if moltin_timeout else DEFAULT_TIMEOUT,
+        rate_limiter=rate_limiter,
+        max_retries=max_retries,
+    )
+    configure_catalog_cache(
+        maxsize=int(os.getenv(
+            'CATALOG_CACHE_SIZE', DEFAULT_CATALOG_CACHE_SIZE,
+        )),
+        ttl=int(os.getenv('CATALOG_CACHE_TTL', DEFAULT_CATALOG_CACHE_TTL)),
+        stale_ttl=int(os.getenv(
+            'CATALOG_STALE_TTL', DEFAULT_CATALOG_STALE_TTL,
+        )),
+        shared=RedisCacheTier(db, CATALOG_SHARED_KEY) if os.getenv(
+            'CATALOG_SHARED_CACHE', 'on') == 'on' else None,
+    )
+    breakers.configure(
+        failure_threshold=int(os.getenv(
+            'BREAKER_FAILURES', DEFAULT_FAILURE_THRESHOLD,
+        )),
+        reset_timeout=float(os.getenv(
+            'BREAKER_RESET_TIMEOUT', DEFAULT_RESET_TIMEOUT,
+        )),
+        latency_budget=float(os.getenv(
+            'UPSTREAM_LATENCY_BUDGET', DEFAULT_LATENCY_BUDGET,
+        )),
+    )
+    signal.signal(signal.SIGHUP, invalidate_catalog_on_signal)
+    configure_geocode_cache(
+        ttl=int(os.getenv('GEOCODE_CACHE_TTL', DEFAULT_GEOCODE_TTL)),
+        negative_ttl=int(os.getenv(
+            'GEOCODE_NEGATIVE_TTL', DEFAULT_GEOCODE_NEGATIVE_TTL,
+        )),
+        memory_size=int(os.getenv(
+            'GEOCODE_MEMORY_SIZE', DEFAULT_GEOCODE_MEMORY_SIZE,
+        )),
+    )
+    configure_cart_mirror(int(os.getenv(
+        'CART_MIRROR_TTL', DEFAULT_CART_MIRROR_TTL,
+    )))
+    configure_menu(int(os.getenv('MENU_PAGE_SIZE', DEFAULT_PAGE_SIZE)))
+    delivery_tariffs = os.getenv('DELIVERY_TARIFFS')
+    if delivery_tariffs:
+        configure_tariffs(parse_tariffs(delivery_tariffs))
+    configure_photo_cache(
+        cache_dir=os.getenv('PHOTO_CACHE_DIR', DEFAULT_PHOTO_CACHE_DIR),
+        max_bytes=int(os.getenv(
+            'PHOTO_CACHE_BYTES', DEFAULT_PHOTO_CACHE_BYTES,
+        )),
+    )
+    start_token_provider(
+        db,
         os.getenv('MOLTIN_CLIENT_ID'),
-        os.getenv('MOLTIN_CLIENT_SECRET')
+        os.getenv('MOLTIN_CLIENT_SECRET'),
+        refresh_margin=int(os.getenv(
+            'MOLTIN_TOKEN_REFRESH_MARGIN', DEFAULT_REFRESH_MARGIN,
+        )),
+        prefetch=False,
+    )
+    warm_up.start(
+        get_warm_up_tasks(db), partial(report_started, on_ready),
     )
-
-    db.set('token', moltin_token['token'])
-    db.set('token_expiration', moltin_token['expires'])
-    db.set('yandex_key', os.getenv('YANDEX_KEY'))
 
     tg_token = os.getenv("TELEGRAM_TOKEN")
-    updater = Updater(tg_token)
+    workers = int(os.getenv('TELEGRAM_WORKERS', DEFAULT_WORKERS))
+    updater = Updater(
+        bot=telegram.Bot(
+            tg_token,
+            request=InstrumentedRequest(con_pool_size=workers + 4),
+        ),
+        workers=workers,
+    )
+
+    if os.getenv('OUTBOX', 'on') == 'on':
+        telegram_rate_limit = float(os.getenv(
+            'TELEGRAM_RATE_LIMIT', DEFAULT_GLOBAL_RATE,
+        ))
+        start_outbox(
+            updater.bot,
+            global_limiter=RedisTokenBucket(
+                db, TELEGRAM_RATE_LIMIT_KEY, telegram_rate_limit,
+            ),
+            chat_rate=float(os.getenv(
+                'TELEGRAM_CHAT_RATE', DEFAULT_CHAT_RATE,
+            )),
+            chat_burst=int(os.getenv(
+                'TELEGRAM_CHAT_BURST', DEFAULT_CHAT_BURST,
+            )),
+            workers=int(os.getenv(
+                'OUTBOX_WORKERS', DEFAULT_SENDER_WORKERS,
+            )),
+        )
+
+    job_queue = updater.job_queue
+    if os.getenv('JOB_QUEUE', 'redis') == 'redis':
+        job_queue = start_job_queue(
+            db,
+            updater.bot,
+            callbacks=[notify_of_delay],
+            poll_interval=float(os.getenv(
+                'JOB_POLL_INTERVAL', DEFAULT_POLL_INTERVAL,
+            )),
+            lease=int(os.getenv('JOB_LEASE', DEFAULT_LEASE)),
+        )
 
     handle_users_reply_partial = partial(
-        handle_users_reply, db, job_queue=updater.job_queue)
+        handle_users_reply, db, job_queue=job_queue)
+    if os.getenv('DISPATCH_MODE') == 'concurrent':
+        start_chat_executor(
+            int(os.getenv('CHAT_WORKERS', DEFAULT_CHAT_WORKERS)),
+        )
+        handle_users_reply_partial = partial(
+            dispatch_by_chat, handle_users_reply_partial,
+        )
 
     dispatcher = updater.dispatcher
+    admin_filter = Filters.chat(chat_id=int(chat_id))
+    dispatcher.add_handler(CommandHandler(
+        'refresh', refresh_catalog, filters=admin_filter,
+    ))
+    dispatcher.add_handler(CommandHandler(
+        'stats', show_stats, filters=admin_filter,
+    ))
+    dispatcher.add_handler(CommandHandler(
+        'profile', configure_profiler, filters=admin_filter,
+    ))
     dispatcher.add_handler(CallbackQueryHandler(
         handle_users_reply_partial, pass_job_queue=True,
     ))
@@ -547,8 +1025,93 @@ def main():
         'start', handle_users_reply_partial, pass_job_queue=True,
     ))
     dispatcher.add_error_handler(error_handler)
-    updater.start_polling()
-    updater.idle()
+    return updater
+
+
+class HeartbeatTick:
+    """Queued among updates, so only a working dispatcher handles it."""
+
+
+def run_worker(updates, heartbeat, ready, worker_number, parent_pid):
+    """Handle updates the supervisor puts into `updates` until None.
+
+    `heartbeat` is set to current time by the dispatcher thread when it
+    handles a tick queued every HEARTBEAT_INTERVAL, so a stuck
+    dispatcher stops it. `ready` is set once caches are warm. Before
+    exiting the worker handles everything it has taken.
+    """
+    global supervisor_pid
+    supervisor_pid = parent_pid
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    updater = create_updater(worker_number, on_ready=ready.set)
+    dispatcher = updater.dispatcher
+
+    def beat(update, context):
+        heartbeat.value = time.time()
+        raise DispatcherHandlerStop()
+    dispatcher.add_handler(TypeHandler(HeartbeatTick, beat), group=-1)
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(
+        target=dispatcher.start, name='dispatcher',
+    )
+    dispatcher_thread.start()
+    tick_sent_at = 0
+    while True:
+        # Next tick only after the last one is handled, so a stuck
+        # dispatcher does not pile them up
+        if heartbeat.value >= tick_sent_at:
+            tick_sent_at = time.time()
+            dispatcher.update_queue.put(HeartbeatTick())
+        try:
+            payload = updates.get(timeout=HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            continue
+        if payload is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(payload, updater.bot))
+
+    while not dispatcher.update_queue.empty() or (
+            chat_dispatch.chat_executor
+            and chat_dispatch.chat_executor.is_busy()):
+        heartbeat.value = time.time()
+        time.sleep(0.1)
+    dispatcher.stop()
+    updater.job_queue.stop()
+    dispatcher_thread.join()
+    if scheduler.job_queue:
+        scheduler.job_queue.stop()
+    if outbox.outbox:
+        outbox.outbox.stop(timeout=OUTBOX_DRAIN_TIMEOUT)
+
+
+def main():
+    """Main function."""
+    updater = create_updater()
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        run_webhook(
+            updater,
+            listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('PORT', DEFAULT_WEBHOOK_PORT)),
+            secret_path=os.getenv(
+                'WEBHOOK_SECRET_PATH', os.getenv('TELEGRAM_TOKEN'),
+            ),
+            secret_token=os.getenv('WEBHOOK_SECRET_TOKEN'),
+            webhook_url=os.getenv('WEBHOOK_URL'),
+            health=warm_up.health,
+        )
+    else:
+        warm_up.wait(float(os.getenv(
+            'WARMUP_TIMEOUT', DEFAULT_WARMUP_TIMEOUT,
+        )))
+        updater.start_polling()
+        updater.idle()
+    if chat_dispatch.chat_executor:
+        chat_dispatch.chat_executor.shutdown()
+    if scheduler.job_queue:
+        scheduler.job_queue.stop()
+    if outbox.outbox:
+        outbox.outbox.stop(timeout=OUTBOX_DRAIN_TIMEOUT)
 
 
 if __name__ == '__main__':
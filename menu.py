@@ -0,0 +1,75 @@
+"""Product menu split into pages, rendered once per catalog version."""
+import threading
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from store import catalog_cache
+
+DEFAULT_PAGE_SIZE = 8
+PAGE_CALLBACK_PREFIX = 'page:'
+
+menu_settings = {'page_size': DEFAULT_PAGE_SIZE}
+_pages_cache = {'products': None, 'version': None, 'pages': []}
+_pages_lock = threading.Lock()
+
+
+def configure_menu(page_size=DEFAULT_PAGE_SIZE):
+    with _pages_lock:
+        menu_settings['page_size'] = page_size
+        _pages_cache['products'] = None
+
+
+def build_menu_pages(products, page_size=DEFAULT_PAGE_SIZE):
+    """Render keyboards for every page of the menu."""
+    chunks = [
+        products[start:start + page_size]
+        for start in range(0, len(products), page_size)
+    ] or [[]]
+    pages = []
+    for number, chunk in enumerate(chunks):
+        keyboard = []
+        for product in chunk:
+            button = [
+                InlineKeyboardButton(
+                    product['name'],
+                    callback_data=product['id'],
+                )
+            ]
+            keyboard.append(button)
+        navigation = []
+        if number > 0:
+            navigation.append(InlineKeyboardButton(
+                '◀', callback_data=f'{PAGE_CALLBACK_PREFIX}{number - 1}',
+            ))
+        if number < len(chunks) - 1:
+            navigation.append(InlineKeyboardButton(
+                '▶', callback_data=f'{PAGE_CALLBACK_PREFIX}{number + 1}',
+            ))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton(
+            'Корзина', callback_data='cart')])
+        pages.append(InlineKeyboardMarkup(keyboard))
+    return pages
+
+
+def get_menu_page(products, page=0):
+    """Return cached keyboard for menu page, rendering pages if needed."""
+    with _pages_lock:
+        if (
+            _pages_cache['products'] is not products
+            or _pages_cache['version'] != catalog_cache.version
+        ):
+            _pages_cache['pages'] = build_menu_pages(
+                products, menu_settings['page_size'],
+            )
+            _pages_cache['products'] = products
+            _pages_cache['version'] = catalog_cache.version
+        pages = _pages_cache['pages']
+    return pages[min(max(page, 0), len(pages) - 1)]
+
+
+def parse_page_callback(callback):
+    """Page number from navigation callback, None for other callbacks."""
+    if callback.startswith(PAGE_CALLBACK_PREFIX):
+        return int(callback[len(PAGE_CALLBACK_PREFIX):])
@@ -0,0 +1,271 @@
+"""Latency histograms and counters served in Prometheus text format.
+
+Recording is a dict lookup and a few additions under a lock; the text
+is rendered only when /metrics is scraped. Nothing is recorded until
+`start_metrics_server` is called.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.utils.request import Request
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+MOLTIN_RESOURCES = {
+    'v2', 'oauth', 'access_token', 'products', 'files', 'carts', 'items',
+    'customers', 'flows', 'fields', 'entries', 'relationships', 'main-image',
+}
+
+logger = logging.getLogger('Logger')
+metrics_settings = {'enabled': False}
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"'),
+        )
+        for name, value in zip(names, values)
+    )
+    return f'{{{pairs}}}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        if not metrics_settings['enabled']:
+            return
+        with self._lock:
+            self.values[label_values] = (
+                self.values.get(label_values, 0) + amount
+            )
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} counter',
+        ]
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}{labels} {value}')
+        return lines
+
+
+class Gauge:
+    """Values read by `collect` only when metrics are scraped.
+
+    `collect` returns a dict of label values and numbers.
+    """
+
+    def __init__(self, name, documentation, labels=(), collect=dict):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} gauge',
+        ]
+        for label_values, value in sorted(self.collect().items()):
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}{labels} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        if not metrics_settings['enabled']:
+            return
+        position = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0,
+                }
+            series['counts'][position] += 1
+            series['sum'] += seconds
+
+    @contextmanager
+    def time(self, *label_values):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *label_values)
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            series = [
+                (label_values, list(value['counts']), value['sum'])
+                for label_values, value in self.series.items()
+            ]
+        names = (*self.labels, 'le')
+        for label_values, counts, total in sorted(series):
+            cumulative = 0
+            bounds = [*map(str, self.buckets), '+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = format_labels(names, (*label_values, bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+state_duration = Histogram(
+    'bot_state_duration_seconds',
+    'Time spent in conversation state handler.',
+    ('state',),
+)
+updates_total = Counter(
+    'bot_updates_total', 'Updates handled by conversation state.', ('state',),
+)
+state_errors_total = Counter(
+    'bot_state_errors_total',
+    'Conversation state handlers that raised an error.',
+    ('state', 'error'),
+)
+upstream_duration = Histogram(
+    'bot_upstream_request_duration_seconds',
+    'Time of requests to external apis.',
+    ('upstream', 'endpoint'),
+)
+upstream_errors_total = Counter(
+    'bot_upstream_errors_total',
+    'Failed requests to external apis.',
+    ('upstream', 'endpoint'),
+)
+redis_duration = Histogram(
+    'bot_redis_command_duration_seconds',
+    'Time of redis commands and pipelines.',
+    ('command',),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+             0.05, 0.1, 0.25, 1),
+)
+redis_errors_total = Counter(
+    'bot_redis_errors_total', 'Failed redis commands.', ('command',),
+)
+chat_queue_depth = Gauge(
+    'bot_chat_queue_depth',
+    'Updates of a chat waiting behind the one being handled.',
+    ('chat',),
+)
+registry = [
+    state_duration,
+    updates_total,
+    state_errors_total,
+    upstream_duration,
+    upstream_errors_total,
+    redis_duration,
+    redis_errors_total,
+    chat_queue_depth,
+]
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def track_upstream(upstream, endpoint):
+    """Time a call to external api, count it as error when it raises."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        upstream_errors_total.inc(upstream, endpoint)
+        raise
+    finally:
+        upstream_duration.observe(
+            time.perf_counter() - started_at, upstream, endpoint,
+        )
+
+
+def get_moltin_endpoint(method, path):
+    """`GET /v2/carts/:id/items` for `GET /v2/carts/42/items?x=1`."""
+    segments = path.split('?', 1)[0].strip('/').split('/')
+    template = '/'.join(
+        segment if segment in MOLTIN_RESOURCES else ':id'
+        for segment in segments
+    )
+    return f'{method} /{template}'
+
+
+class InstrumentedRequest(Request):
+    """Telegram bot api connection that times every api method."""
+
+    def post(self, url, data, timeout=None):
+        with track_upstream('telegram', url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+    def retrieve(self, url, timeout=None):
+        with track_upstream('telegram', 'getFileContent'):
+            return super().retrieve(url, timeout=timeout)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(listen, port):
+    """Start recording metrics and serve them from a daemon thread."""
+    metrics_settings['enabled'] = True
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True,
+    ).start()
+    logger.info('Metrics served on %s:%s', listen, port)
+    return server
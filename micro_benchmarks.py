@@ -0,0 +1,236 @@
+"""Micro-benchmarks of pure hot paths with a stored baseline.
+
+Every case runs on fixed fixture data. Timings are kept relative to a
+calibration loop measured next to each case, so a slower or busier
+machine shifts both alike. `--save` writes the relative timings as the
+baseline, which is not committed: save it on the machine that checks
+changes. Without `--save` the run is compared with the baseline and
+exits with status 1 when some case got slower than the threshold
+allows.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from unittest import mock
+
+import main
+from benchmarks import make_customers, make_pizzerias
+from get_location import get_closest_pizzeria, measure_distance
+from menu import build_menu_pages, configure_menu
+
+DEFAULT_BASELINE = 'benchmarks_baseline.json'
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_REPEAT = 7
+MIN_REPEAT_TIME = 0.1
+
+
+def make_products(count):
+    return [
+        {'id': f'product-{number}', 'name': f'Пицца {number}'}
+        for number in range(count)
+    ]
+
+
+def make_cart_items(count):
+    return [
+        {
+            'id': f'item-product-{number}',
+            'name': f'Пицца {number}',
+            'description': 'Тесто, томатный соус, моцарелла, базилик',
+            'quantity': 1 + number % 3,
+            'value': {'amount': 500 + number * 10},
+        }
+        for number in range(count)
+    ]
+
+
+def closest_pizzeria_case(pizzerias_count):
+    def setup():
+        pizzerias = make_pizzerias(pizzerias_count)
+        customers = make_customers(100)
+        get_closest_pizzeria(customers[0], pizzerias)
+        position = iter(range(sys.maxsize))
+
+        def run():
+            customer = customers[next(position) % len(customers)]
+            get_closest_pizzeria(customer, pizzerias)
+        return run
+    return setup
+
+
+def setup_measure_distance():
+    customers = make_customers(2)
+    (lon_a, lat_a), (lon_b, lat_b) = customers
+    return lambda: measure_distance(lon_a, lat_a, lon_b, lat_b)
+
+
+def setup_customer_cart():
+    cart_items = make_cart_items(20)
+    patches = (
+        mock.patch.object(main, 'get_token', return_value='token'),
+        mock.patch.object(
+            main, 'get_mirrored_cart_items', return_value=cart_items,
+        ),
+    )
+    for patch in patches:
+        patch.start()
+    return lambda: main.get_customer_cart(None, 1)
+
+
+def setup_product_keyboard():
+    products = make_products(1000)
+    configure_menu()
+    main.get_product_keyboard(products)
+    position = iter(range(sys.maxsize))
+    return lambda: main.get_product_keyboard(products, next(position) % 125)
+
+
+def setup_build_menu_pages():
+    products = make_products(1000)
+    return lambda: build_menu_pages(products)
+
+
+def setup_delivery_callback():
+    data = 'delivery;55.7558;37.6173;123456789;300'
+    return lambda: main.parse_delivery_callback(data)
+
+
+CASES = {
+    'closest_pizzeria_10': closest_pizzeria_case(10),
+    'closest_pizzeria_1k': closest_pizzeria_case(1000),
+    'closest_pizzeria_100k': closest_pizzeria_case(100000),
+    'measure_distance': setup_measure_distance,
+    'customer_cart_20_items': setup_customer_cart,
+    'product_keyboard_1k_cached': setup_product_keyboard,
+    'menu_pages_1k_render': setup_build_menu_pages,
+    'delivery_callback_parse': setup_delivery_callback,
+}
+
+
+def measure(function, repeat=DEFAULT_REPEAT):
+    """Best time of one call among `repeat` timed loops.
+
+    Garbage collection is off while timing, as in `timeit`.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        return _measure(function, repeat)
+    finally:
+        gc.enable()
+
+
+def _measure(function, repeat):
+    loops = 1
+    while True:
+        started_at = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - started_at
+        if elapsed >= MIN_REPEAT_TIME:
+            break
+        loops *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        started_at = time.perf_counter()
+        for _ in range(loops):
+            function()
+        best = min(best, time.perf_counter() - started_at)
+    return best / loops
+
+
+def calibration_loop():
+    """Plain dict, list and string work, the bulk of the bot code."""
+    items = {}
+    for number in range(200):
+        key = f'item-{number}'
+        items[key] = [number, key.upper()]
+    return sorted(items.values(), reverse=True)
+
+
+def run_cases(names, repeat=DEFAULT_REPEAT):
+    """Time of each case in calibration loop runs.
+
+    The loop is timed next to every case, so a change of machine speed
+    during the run, as on a shared CI host, shifts both alike.
+    """
+    try:
+        results = {}
+        for name in names:
+            function = CASES[name]()
+            calibration = measure(calibration_loop, repeat)
+            elapsed = measure(function, repeat)
+            calibration = min(
+                calibration, measure(calibration_loop, repeat),
+            )
+            results[name] = elapsed / calibration
+        return results
+    finally:
+        mock.patch.stopall()
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Print timings against baseline, return names of regressed cases."""
+    regressed = []
+    for name, elapsed in results.items():
+        line = f'{name:>28}: {elapsed:10.3f} units'
+        if name in baseline:
+            ratio = elapsed / baseline[name]
+            line += f'  baseline {baseline[name]:10.3f} units  x{ratio:.2f}'
+            if ratio > 1 + threshold:
+                regressed.append(name)
+                line += '  REGRESSION'
+        print(line)
+    return regressed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description='Run micro-benchmarks and compare with baseline.',
+    )
+    parser.add_argument(
+        'cases', nargs='*', help='Cases to run, all by default.',
+    )
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='Allowed slowdown, 0.25 fails a case 25%% slower than baseline.',
+    )
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument(
+        '--save', action='store_true',
+        help='Write results as the new baseline.',
+    )
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f'unknown cases: {", ".join(sorted(unknown))}')
+
+    results = run_cases(args.cases or list(CASES), args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    if args.save:
+        compare(results, {})
+        baseline.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        return
+    if not baseline:
+        compare(results, {})
+        sys.exit(
+            f'No baseline in {args.baseline}, save one with --save '
+            f'on this machine first'
+        )
+    regressed = compare(results, baseline, args.threshold)
+    if regressed:
+        print(f'Slower than baseline: {", ".join(regressed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
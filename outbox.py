@@ -0,0 +1,243 @@
+"""Outgoing bot api calls queued by chat and sent within Telegram limits.
+
+Handlers put calls into the outbox and go on. Sender threads take the
+most urgent chat whose own token bucket has a token, so replies to a
+customer go ahead of courier messages and delayed notifications, while
+calls to one chat keep their order. A message queued behind another
+plain message to the same chat is merged into it.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+from rate_limit import TokenBucket
+
+PRIORITY_REPLY = 0
+PRIORITY_COURIER = 1
+PRIORITY_NOTIFICATION = 2
+
+DEFAULT_GLOBAL_RATE = 30
+DEFAULT_CHAT_RATE = 1
+DEFAULT_CHAT_BURST = 3
+DEFAULT_SENDER_WORKERS = 4
+MAX_MESSAGE_LENGTH = 4096
+MESSAGE_SEPARATOR = '\n\n'
+
+logger = logging.getLogger('Logger')
+
+
+def get_options(kwargs):
+    return {
+        key: value for key, value in kwargs.items()
+        if key not in ('text', 'reply_markup')
+    }
+
+
+class OutgoingCall:
+    def __init__(self, sequence, priority, method, kwargs):
+        self.sequence = sequence
+        self.priority = priority
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = [Future()]
+
+    def merge(self, other):
+        """Append text of a later plain message, True when merged.
+
+        The earlier message must have no keyboard; the merged one gets
+        the keyboard of the later message.
+        """
+        if (
+            self.method != 'send_message'
+            or other.method != 'send_message'
+            or self.kwargs.get('reply_markup') is not None
+            or get_options(self.kwargs) != get_options(other.kwargs)
+        ):
+            return False
+        text = MESSAGE_SEPARATOR.join(
+            (self.kwargs['text'], other.kwargs['text']),
+        )
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.kwargs = {**other.kwargs, 'text': text}
+        self.priority = min(self.priority, other.priority)
+        self.futures.extend(other.futures)
+        return True
+
+
+class ChatQueue:
+    def __init__(self, rate, capacity):
+        self.calls = deque()
+        self.bucket = TokenBucket(rate, capacity)
+        self.busy = False
+
+
+class Outbox:
+    def __init__(self, bot, global_limiter=None,
+                 chat_rate=DEFAULT_CHAT_RATE, chat_burst=DEFAULT_CHAT_BURST,
+                 workers=DEFAULT_SENDER_WORKERS):
+        self.bot = bot
+        self.global_limiter = global_limiter or TokenBucket(
+            DEFAULT_GLOBAL_RATE,
+        )
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.chats = {}
+        self.paused_until = 0
+        self.counters = {
+            'queued': 0,
+            'sent': 0,
+            'merged': 0,
+            'flood_waits': 0,
+            'failed': 0,
+        }
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def send(self, method, chat_id, priority=PRIORITY_REPLY, **kwargs):
+        """Queue bot method call, return future of its result."""
+        call = OutgoingCall(next(self._sequence), priority, method, kwargs)
+        with self._condition:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = ChatQueue(
+                    self.chat_rate, self.chat_burst,
+                )
+            self.counters['queued'] += 1
+            if chat.calls and chat.calls[-1].merge(call):
+                self.counters['merged'] += 1
+            else:
+                chat.calls.append(call)
+                self._condition.notify()
+        return call.futures[0]
+
+    def _pick(self, now):
+        """Most urgent ready chat, or None and seconds to wait."""
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        best = None
+        wait = None
+        for chat_id, chat in list(self.chats.items()):
+            if chat.busy:
+                continue
+            if not chat.calls:
+                if chat.bucket.is_idle(now):
+                    del self.chats[chat_id]
+                continue
+            delay = chat.bucket.get_delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = chat.calls[0]
+            if best is None or (head.priority, head.sequence) < (
+                    best[1].calls[0].priority, best[1].calls[0].sequence):
+                best = chat_id, chat
+        return best, wait
+
+    def _take(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                best, wait = self._pick(now)
+                if best is not None:
+                    chat_id, chat = best
+                    chat.busy = True
+                    chat.bucket.take(now)
+                    return chat_id, chat, chat.calls.popleft()
+                if self._stopped and not any(
+                        chat.calls or chat.busy
+                        for chat in self.chats.values()):
+                    return None
+                self._condition.wait(wait)
+
+    def run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            chat_id, chat, call = taken
+            self.global_limiter.acquire()
+            try:
+                result = getattr(self.bot, call.method)(
+                    chat_id=chat_id, **call.kwargs,
+                )
+            except RetryAfter as error:
+                with self._condition:
+                    chat.calls.appendleft(call)
+                    self.paused_until = max(
+                        self.paused_until,
+                        time.monotonic() + error.retry_after,
+                    )
+                    self.counters['flood_waits'] += 1
+                logger.warning(
+                    f'Telegram flood wait {error.retry_after} s, '
+                    f'sending paused'
+                )
+            except Exception as error:
+                with self._condition:
+                    self.counters['failed'] += 1
+                logger.exception(f'Bot call {call.method} failed')
+                for future in call.futures:
+                    future.set_exception(error)
+            else:
+                with self._condition:
+                    self.counters['sent'] += 1
+                for future in call.futures:
+                    future.set_result(result)
+            finally:
+                with self._condition:
+                    chat.busy = False
+                    self._condition.notify_all()
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, name=f'outbox-{number}', daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Send what is queued, then stop sender threads."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.counters)
+            stats['pending'] = sum(
+                len(chat.calls) for chat in self.chats.values()
+            )
+        return stats
+
+
+outbox = None
+
+
+def start_outbox(bot, global_limiter=None, chat_rate=DEFAULT_CHAT_RATE,
+                 chat_burst=DEFAULT_CHAT_BURST,
+                 workers=DEFAULT_SENDER_WORKERS):
+    global outbox
+    outbox = Outbox(bot, global_limiter, chat_rate, chat_burst, workers)
+    outbox.start()
+    return outbox
+
+
+def send(bot, method, chat_id, priority=PRIORITY_REPLY, **kwargs):
+    """Queue call in the outbox, or make it right away without one."""
+    if outbox is not None:
+        return outbox.send(method, chat_id, priority, **kwargs)
+    future = Future()
+    future.set_result(getattr(bot, method)(chat_id=chat_id, **kwargs))
+    return future
@@ -0,0 +1,105 @@
+"""Product photos: Telegram file_id registry and on-disk byte cache."""
+import os
+import tempfile
+import threading
+
+from store import get_file, get_photo
+
+PHOTO_IDS_KEY = 'photo_file_ids'
+DEFAULT_PHOTO_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'pizza_photos')
+DEFAULT_PHOTO_CACHE_BYTES = 50 * 1024 * 1024
+
+photo_file_ids = {}
+photo_cache = {
+    'dir': DEFAULT_PHOTO_CACHE_DIR,
+    'max_bytes': DEFAULT_PHOTO_CACHE_BYTES,
+}
+_cache_lock = threading.Lock()
+
+
+def configure_photo_cache(
+    cache_dir=DEFAULT_PHOTO_CACHE_DIR,
+    max_bytes=DEFAULT_PHOTO_CACHE_BYTES,
+):
+    photo_cache['dir'] = cache_dir
+    photo_cache['max_bytes'] = max_bytes
+
+
+def load_photo_ids(db):
+    """Load every known file_id from redis into memory."""
+    for image_id, file_id in db.hgetall(PHOTO_IDS_KEY).items():
+        photo_file_ids[image_id.decode('utf-8')] = file_id.decode('utf-8')
+    return len(photo_file_ids)
+
+
+def get_photo_id(db, image_id):
+    file_id = photo_file_ids.get(image_id)
+    if file_id:
+        return file_id
+    file_id = db.hget(PHOTO_IDS_KEY, image_id)
+    if file_id:
+        file_id = file_id.decode('utf-8')
+        photo_file_ids[image_id] = file_id
+        return file_id
+
+
+def remember_photo_id(db, image_id, file_id):
+    """Save file_id returned by Telegram for moltin image."""
+    if photo_file_ids.get(image_id) == file_id:
+        return
+    photo_file_ids[image_id] = file_id
+    db.hset(PHOTO_IDS_KEY, image_id, file_id)
+
+
+def forget_photo_id(db, image_id):
+    """Drop file_id that Telegram does not accept anymore."""
+    photo_file_ids.pop(image_id, None)
+    db.hdel(PHOTO_IDS_KEY, image_id)
+
+
+def get_cached_photo_bytes(image_id, access_token):
+    """Read photo from disk cache or download it from moltin."""
+    os.makedirs(photo_cache['dir'], exist_ok=True)
+    path = os.path.join(photo_cache['dir'], image_id)
+    try:
+        with open(path, 'rb') as file:
+            photo = file.read()
+        os.utime(path)
+        return photo
+    except FileNotFoundError:
+        pass
+    file = get_file(file_id=image_id, access_token=access_token)
+    photo = get_photo(link=file['link']['href'])
+    descriptor, temp_path = tempfile.mkstemp(dir=photo_cache['dir'])
+    with os.fdopen(descriptor, 'wb') as temp_file:
+        temp_file.write(photo)
+    os.replace(temp_path, path)
+    trim_photo_cache()
+    return photo
+
+
+def trim_photo_cache():
+    """Remove least recently used photos above the size limit."""
+    with _cache_lock:
+        entries = []
+        for entry in os.scandir(photo_cache['dir']):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= photo_cache['max_bytes']:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def get_product_photo(db, image_id, access_token):
+    """Return Telegram file_id when known, photo bytes otherwise."""
+    return (
+        get_photo_id(db, image_id)
+        or get_cached_photo_bytes(image_id, access_token)
+    )
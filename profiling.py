@@ -0,0 +1,186 @@
+"""Profiling of chosen conversation states or chats, switched at runtime.
+
+When profiling is off, `profiler.active` is False and handlers run as
+before. When it is on, a `rate` share of matching updates is captured
+either with cProfile, written as a pstats file per update, or by
+sampling the handler thread stack every `interval` seconds, appended to
+`<state>.collapsed` for flame graphs (flamegraph.pl, speedscope).
+"""
+import cProfile
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+MODE_CPROFILE = 'cprofile'
+MODE_STACK = 'stack'
+MODES = (MODE_CPROFILE, MODE_STACK)
+DEFAULT_RATE = 1
+DEFAULT_INTERVAL = 0.005
+DEFAULT_PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'pizza_bot_profiles')
+
+logger = logging.getLogger('Logger')
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)})'
+
+
+def collapse_stack(frame):
+    """`outer;inner;leaf` names of frame and its callers."""
+    names = []
+    while frame is not None:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Count stacks of one thread from a background thread."""
+
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self.run, name='stack-sampler', daemon=True,
+        )
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class Profiler:
+    def __init__(self):
+        self.active = False
+        self.mode = MODE_CPROFILE
+        self.rate = DEFAULT_RATE
+        self.interval = DEFAULT_INTERVAL
+        self.states = set()
+        self.chat_ids = set()
+        self.directory = DEFAULT_PROFILE_DIR
+        self.captured = 0
+        self._lock = threading.Lock()
+
+    def configure(self, mode=MODE_CPROFILE, rate=DEFAULT_RATE, states=(),
+                  chat_ids=(), interval=DEFAULT_INTERVAL, directory=None):
+        """Profile updates in any of `states` or `chat_ids`.
+
+        With neither given every update matches.
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiling mode {mode}')
+        if not 0 < rate <= 1:
+            raise ValueError(f'Profiling rate {rate} is not in (0, 1]')
+        self.mode = mode
+        self.rate = rate
+        self.interval = interval
+        self.states = set(states)
+        self.chat_ids = set(chat_ids)
+        self.directory = directory or self.directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.active = True
+
+    def disable(self):
+        self.active = False
+
+    def should_capture(self, state, chat_id):
+        if (self.states or self.chat_ids) and not (
+                state in self.states or chat_id in self.chat_ids):
+            return False
+        return random.random() < self.rate
+
+    @contextmanager
+    def capture(self, state, chat_id):
+        """Profile the body if this update is picked, else just run it."""
+        if not self.should_capture(state, chat_id):
+            yield
+            return
+        if self.mode == MODE_STACK:
+            with self._sample_stack(state):
+                yield
+        else:
+            with self._run_cprofile(state, chat_id):
+                yield
+
+    @contextmanager
+    def _run_cprofile(self, state, chat_id):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is running in this interpreter.
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            filename = f'{state}-{int(time.time() * 1000)}-{chat_id}.pstats'
+            profile.dump_stats(os.path.join(self.directory, filename))
+            self._count()
+
+    @contextmanager
+    def _sample_stack(self, state):
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            lines = [
+                f'{state};{stack} {count}\n'
+                for stack, count in sampler.stacks.items()
+            ]
+            path = os.path.join(self.directory, f'{state}.collapsed')
+            with self._lock, open(path, 'a') as collapsed_file:
+                collapsed_file.writelines(lines)
+            self._count()
+
+    def _count(self):
+        with self._lock:
+            self.captured += 1
+
+    def describe(self):
+        if not self.active:
+            return 'Профилирование выключено.'
+        targets = [*sorted(self.states), *map(str, sorted(self.chat_ids))]
+        return (
+            f'Профилирование {self.mode}, доля {self.rate:g}, '
+            f'цели: {", ".join(targets) or "все обновления"}.\n'
+            f'Снято профилей: {self.captured}, папка {self.directory}'
+        )
+
+
+profiler = Profiler()
+
+
+def parse_targets(targets):
+    """Split `HANDLE_MENU 12345` into states and chat ids."""
+    states = []
+    chat_ids = []
+    for target in targets:
+        if target.lstrip('-').isdigit():
+            chat_ids.append(int(target))
+        elif target.isidentifier():
+            states.append(target.upper())
+        else:
+            raise ValueError(f'Not a state or chat id: {target}')
+    return states, chat_ids
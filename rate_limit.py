@@ -0,0 +1,153 @@
+"""Request budget shared by all bot processes and retry delays."""
+import datetime
+import email.utils
+import math
+import random
+import threading
+import time
+
+DEFAULT_BACKOFF = 0.5
+MAX_RETRY_DELAY = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+tokens = tokens - 1
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisTokenBucket:
+    """Token bucket kept in redis, so every process spends one budget.
+
+    A request that finds the bucket empty takes its token in advance
+    and waits for the time it needs to refill.
+    """
+
+    def __init__(self, db, key, rate, capacity=None):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.script = db.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self):
+        """Take one token, return seconds spent waiting for it."""
+        wait = float(self.script(
+            keys=[self.key],
+            args=[self.rate, self.capacity, time.time()],
+        ))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class TokenBucket:
+    """Token bucket of one process, with the interface of the redis one."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + max(0, now - self.updated_at) * self.rate,
+        )
+        self.updated_at = now
+
+    def get_delay(self, now):
+        """Seconds until a token is available, without taking it."""
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+    def acquire(self):
+        """Take one token, return seconds spent waiting for it."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self.get_delay(now)
+            self.take(now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RequestStats:
+    """Counters of requests, throttled responses and retries."""
+
+    def __init__(self):
+        self.counters = {
+            'requests': 0,
+            'throttled': 0,
+            'retried': 0,
+            'budget_waits': 0,
+        }
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def get_retry_after(headers):
+    """Seconds from Retry-After header, None when it is absent or bad.
+
+    A date without time zone is taken as UTC, like HTTP dates are.
+    """
+    retry_after = headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        seconds = retry_at.timestamp() - time.time()
+    if not math.isfinite(seconds):
+        return None
+    return max(seconds, 0)
+
+
+def get_retry_delay(headers, attempt, backoff=DEFAULT_BACKOFF):
+    """Delay before next attempt: Retry-After or jittered backoff."""
+    retry_after = get_retry_after(headers)
+    if retry_after is None:
+        retry_after = random.uniform(0, backoff * 2 ** attempt)
+    return min(retry_after, MAX_RETRY_DELAY)
+
+
+def should_retry(method, status):
+    """429 was not processed and can be repeated, 5xx only for GET."""
+    if status == 429:
+        return True
+    return method == 'GET' and status in RETRY_STATUSES
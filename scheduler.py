@@ -0,0 +1,188 @@
+"""Delayed jobs kept in redis and run by any bot replica.
+
+A job is an id in a sorted set scored by its due time plus a json
+payload in a hash. Pollers claim due jobs with a Lua script that moves
+them `lease` seconds into the future, and remove them once the callback
+has finished. A callback that only queues its work, like a message put
+in the outbox, returns a future, and the job is removed when the future
+is done. A job whose poller died before that becomes due again when the
+lease runs out, so every job runs at least once.
+"""
+import datetime
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import Future
+
+DEFAULT_JOBS_KEY = 'delayed_jobs'
+DEFAULT_POLL_INTERVAL = 1
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_LEASE = 5 * 60
+DEFAULT_MAX_ATTEMPTS = 5
+
+CLAIM_SCRIPT = '''
+local due = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+local claimed = {}
+for _, job_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], job_id)
+    local attempts = redis.call('HINCRBY', KEYS[3], job_id, 1)
+    local payload = redis.call('HGET', KEYS[2], job_id)
+    table.insert(claimed, {job_id, payload or false, attempts})
+end
+return claimed
+'''
+
+logger = logging.getLogger('Logger')
+
+Job = namedtuple('Job', 'id name context attempts')
+JobContext = namedtuple('JobContext', 'bot job')
+
+
+def get_delay(when):
+    """Seconds until `when`, given as seconds, timedelta or datetime."""
+    if isinstance(when, datetime.timedelta):
+        return when.total_seconds()
+    if isinstance(when, datetime.datetime):
+        return when.timestamp() - time.time()
+    return when
+
+
+class RedisJobQueue:
+    """Replacement for `JobQueue.run_once` that survives restarts.
+
+    Callbacks get an object with `bot` and `job.context`, like the
+    CallbackContext of telegram jobs. They are found by name, so every
+    replica has to register the callbacks it may run.
+    """
+
+    def __init__(self, db, bot, key=DEFAULT_JOBS_KEY,
+                 poll_interval=DEFAULT_POLL_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE, lease=DEFAULT_LEASE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.db = db
+        self.bot = bot
+        self.key = key
+        self.payloads_key = f'{key}:payloads'
+        self.attempts_key = f'{key}:attempts'
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.callbacks = {}
+        self.claim_script = db.register_script(CLAIM_SCRIPT)
+        self._stopped = threading.Event()
+
+    def register(self, callback, name=None):
+        self.callbacks[name or callback.__name__] = callback
+
+    def run_once(self, callback, when, context=None, name=None):
+        """Schedule callback; context has to be json serializable."""
+        name = name or callback.__name__
+        self.register(callback, name)
+        job_id = uuid.uuid4().hex
+        payload = json.dumps({'name': name, 'context': context})
+        pipeline = self.db.pipeline()
+        pipeline.hset(self.payloads_key, job_id, payload)
+        pipeline.zadd(self.key, {job_id: time.time() + get_delay(when)})
+        pipeline.execute()
+        return job_id
+
+    def claim(self):
+        """Lease due jobs to this poller, at most `batch_size` of them."""
+        now = time.time()
+        claimed = self.claim_script(
+            keys=[self.key, self.payloads_key, self.attempts_key],
+            args=[now, now + self.lease, self.batch_size],
+        )
+        jobs = []
+        for job_id, payload, attempts in claimed:
+            job_id = job_id.decode('utf-8')
+            if not payload:
+                self.ack(job_id)
+                continue
+            payload = json.loads(payload)
+            jobs.append(
+                Job(job_id, payload['name'], payload['context'], attempts),
+            )
+        return jobs
+
+    def ack(self, job_id):
+        pipeline = self.db.pipeline()
+        pipeline.zrem(self.key, job_id)
+        pipeline.hdel(self.payloads_key, job_id)
+        pipeline.hdel(self.attempts_key, job_id)
+        pipeline.execute()
+
+    def run_job(self, job):
+        """Run job, finish it now or when its returned future is done."""
+        try:
+            callback = self.callbacks[job.name]
+            result = callback(JobContext(self.bot, job))
+        except Exception as error:
+            self.finish(job, error)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(
+                lambda future: self.finish(job, future.exception()),
+            )
+        else:
+            self.finish(job)
+
+    def finish(self, job, error=None):
+        """Ack job, leave a failed one to be claimed again after lease."""
+        if error is not None:
+            if job.attempts < self.max_attempts:
+                logger.error(
+                    'Delayed job %s failed, attempt %s', job.name,
+                    job.attempts, exc_info=error,
+                )
+                return
+            logger.error(
+                'Delayed job %s dropped', job.name, exc_info=error,
+            )
+        self.ack(job.id)
+
+    def run_due(self):
+        """Run claimed jobs until no due jobs are left, return count."""
+        done = 0
+        while True:
+            jobs = self.claim()
+            for job in jobs:
+                self.run_job(job)
+            done += len(jobs)
+            if len(jobs) < self.batch_size:
+                return done
+
+    def run(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception('Delayed jobs polling failed')
+
+    def start(self):
+        threading.Thread(
+            target=self.run, name='delayed-jobs', daemon=True,
+        ).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def pending(self):
+        return self.db.zcard(self.key)
+
+
+job_queue = None
+
+
+def start_job_queue(db, bot, callbacks=(), **kwargs):
+    global job_queue
+    job_queue = RedisJobQueue(db, bot, **kwargs)
+    for callback in callbacks:
+        job_queue.register(callback)
+    job_queue.start()
+    return job_queue
@@ -0,0 +1,131 @@
+"""Chat state kept in one redis hash per chat."""
+import time
+
+import redis
+from redis.client import Pipeline
+
+from metrics import redis_duration, redis_errors_total
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_SOCKET_TIMEOUT = 5
+CHAT_KEY_PREFIX = 'chat:'
+
+
+def observe_redis(command, started_at, failed):
+    redis_duration.observe(time.perf_counter() - started_at, command)
+    if failed:
+        redis_errors_total.inc(command)
+
+
+class InstrumentedPipeline(Pipeline):
+    """Pipeline timed as one operation named after its commands."""
+
+    def execute(self, raise_on_error=True):
+        commands = dict.fromkeys(
+            str(args[0]).upper() for args, _ in self.command_stack
+        )
+        command = 'PIPELINE ' + ','.join(commands)
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(raise_on_error)
+            failed = False
+            return result
+        finally:
+            observe_redis(command, started_at, failed)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client timing every command by its name."""
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute_command(*args, **options)
+            failed = False
+            return result
+        finally:
+            observe_redis(command, started_at, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+        )
+
+
+def create_redis(host, port, password,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 socket_timeout=DEFAULT_SOCKET_TIMEOUT):
+    """Redis client with bounded connection pool and socket timeouts."""
+    pool = redis.ConnectionPool(
+        host=host,
+        port=port,
+        password=password,
+        max_connections=max_connections,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_timeout,
+    )
+    return InstrumentedRedis(connection_pool=pool)
+
+
+class ChatSession:
+    """Chat fields loaded with one pipelined read, saved with one write.
+
+    Chats saved before sessions existed keep their state under the bare
+    chat_id key; it is read once and moved into the hash on save.
+    """
+
+    def __init__(self, db, chat_id, data, legacy_state=None):
+        self.db = db
+        self.chat_id = chat_id
+        self.data = data
+        self.changes = {}
+        self.legacy_state = legacy_state
+        if legacy_state and 'state' not in data:
+            self.set('state', legacy_state)
+
+    @classmethod
+    def load(cls, db, chat_id):
+        pipeline = db.pipeline(transaction=False)
+        pipeline.hgetall(f'{CHAT_KEY_PREFIX}{chat_id}')
+        pipeline.get(chat_id)
+        fields, legacy_state = pipeline.execute()
+        data = {
+            key.decode('utf-8'): value.decode('utf-8')
+            for key, value in fields.items()
+        }
+        if legacy_state:
+            legacy_state = legacy_state.decode('utf-8')
+        return cls(db, chat_id, data, legacy_state)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.changes[key] = value
+
+    @property
+    def state(self):
+        return self.get('state')
+
+    @state.setter
+    def state(self, value):
+        self.set('state', value)
+
+    def save(self):
+        if not self.changes and not self.legacy_state:
+            return
+        pipeline = self.db.pipeline(transaction=False)
+        if self.changes:
+            pipeline.hmset(f'{CHAT_KEY_PREFIX}{self.chat_id}', self.changes)
+        if self.legacy_state:
+            pipeline.delete(self.chat_id)
+        pipeline.execute()
+        self.changes = {}
+        self.legacy_state = None
@@ -1,82 +1,231 @@
 """Module to operate moltin store api."""
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from cache import TTLCache
+from circuit import breakers
+from metrics import get_moltin_endpoint, track_upstream, upstream_errors_total
+from rate_limit import RequestStats, get_retry_delay, should_retry
+
+MOLTIN_API_URL = 'https://api.moltin.com'
+PIZZERIAS_FLOW_SLUG = 'pizzeria-1'
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_CATALOG_CACHE_SIZE = 512
+DEFAULT_CATALOG_CACHE_TTL = 10 * 60
+DEFAULT_CATALOG_STALE_TTL = 24 * 60 * 60
+PAGE_LIMIT = 100
+
+
+def is_upstream_failure(status):
+    """Overload and server errors count against the circuit breaker."""
+    return status == 429 or status >= 500
+
+
+class MoltinClient:
+    """Moltin api client sharing one keep-alive connection pool."""
+
+    def __init__(
+        self,
+        base_url=MOLTIN_API_URL,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+        rate_limiter=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.stats = RequestStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, access_token=None, headers=None,
+                **kwargs):
+        """Send request to moltin api and raise on error status.
+
+        Throttled requests and failed GETs are repeated up to
+        `max_retries` times, waiting as long as Retry-After asks or
+        with jittered exponential backoff. Every attempt is counted by
+        the endpoint circuit breaker on its own, without the waits.
+        """
+        request_headers = {}
+        if access_token:
+            request_headers['Authorization'] = f'Bearer {access_token}'
+        request_headers.update(headers or {})
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = get_moltin_endpoint(method, path)
+        response = self.send(
+            method, path, endpoint, request_headers, **kwargs,
+        )
+        if response.status_code >= 400:
+            upstream_errors_total.inc('moltin', endpoint)
+        response.raise_for_status()
+        return response
+
+    def send(self, method, path, endpoint, headers, **kwargs):
+        """Send request, repeating it while it may be retried."""
+        breaker = breakers.get(f'moltin {endpoint}')
+        for attempt in range(self.max_retries + 1):
+            # Budget first: a limiter error must not hold the breaker's
+            # half-open trial taken by allow()
+            if self.rate_limiter and self.rate_limiter.acquire():
+                self.stats.count('budget_waits')
+            breaker.allow()
+            self.stats.count('requests')
+            started_at = time.monotonic()
+            failed = True
+            try:
+                with track_upstream('moltin', endpoint):
+                    response = self.session.request(
+                        method,
+                        f'{self.base_url}{path}',
+                        headers=headers,
+                        **kwargs,
+                    )
+                failed = is_upstream_failure(response.status_code)
+            finally:
+                breaker.record(time.monotonic() - started_at, failed)
+            if response.status_code == 429:
+                self.stats.count('throttled')
+            if (
+                attempt == self.max_retries
+                or not should_retry(method, response.status_code)
+            ):
+                break
+            self.stats.count('retried')
+            time.sleep(get_retry_delay(response.headers, attempt))
+        return response
+
+    def download(self, link):
+        """Download file by absolute link through the same pool."""
+        def download():
+            with track_upstream('moltin', 'GET file content'):
+                response = self.session.get(link, timeout=self.timeout)
+            response.raise_for_status()
+            return response.content
+        return breakers.get('moltin GET file content').call(download)
+
+    def close(self):
+        self.session.close()
+
+
+client = MoltinClient()
+catalog_cache = TTLCache(
+    maxsize=DEFAULT_CATALOG_CACHE_SIZE,
+    ttl=DEFAULT_CATALOG_CACHE_TTL,
+    stale_ttl=DEFAULT_CATALOG_STALE_TTL,
+)
+
+
+def configure_client(
+    base_url=MOLTIN_API_URL,
+    pool_size=DEFAULT_POOL_SIZE,
+    timeout=DEFAULT_TIMEOUT,
+    rate_limiter=None,
+    max_retries=DEFAULT_MAX_RETRIES,
+):
+    """Replace module client with a newly configured one."""
+    global client
+    old_client = client
+    client = MoltinClient(
+        base_url=base_url,
+        pool_size=pool_size,
+        timeout=timeout,
+        rate_limiter=rate_limiter,
+        max_retries=max_retries,
+    )
+    old_client.close()
+    return client
+
+
+def configure_catalog_cache(
+    maxsize=DEFAULT_CATALOG_CACHE_SIZE,
+    ttl=DEFAULT_CATALOG_CACHE_TTL,
+    stale_ttl=DEFAULT_CATALOG_STALE_TTL,
+    shared=None,
+):
+    """Resize catalog cache and drop everything cached so far.
+
+    For `stale_ttl` seconds after expiration catalog entries are still
+    served while a fresh copy is loaded in background, which also
+    keeps the bot answering while moltin is down.
+    """
+    catalog_cache.maxsize = maxsize
+    catalog_cache.ttl = ttl
+    catalog_cache.stale_ttl = stale_ttl
+    catalog_cache.invalidate()
+    catalog_cache.shared = shared
 
 
 def authenticate(client_id, client_secret):
     """Authenticate."""
-    response = requests.post(
-        'https://api.moltin.com/oauth/access_token',
+    response = client.request(
+        'POST',
+        '/oauth/access_token',
         data={
             'client_id': client_id,
             'client_secret': client_secret,
             'grant_type': 'client_credentials'
         }
     )
-    response.raise_for_status()
     payload = response.json()
     return {'token': payload['access_token'], 'expires': payload['expires']}
 
 
 def get_all_products(access_token):
     """Get all products in store."""
-    response = requests.get(
-        'https://api.moltin.com/v2/products',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        }
-    )
-    response.raise_for_status()
-    return response.json()['data']
+    def load():
+        response = client.request('GET', '/v2/products', access_token)
+        return response.json()['data']
+    return catalog_cache.get_or_refresh('products', load)
 
 
 def get_file(file_id, access_token):
     """Get image file."""
-    response = requests.get(
-        f'https://api.moltin.com/v2/files/{file_id}',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        }
-    )
-    response.raise_for_status()
-    return response.json()['data']
+    def load():
+        response = client.request(
+            'GET', f'/v2/files/{file_id}', access_token,
+        )
+        return response.json()['data']
+    return catalog_cache.get_or_refresh(('file', file_id), load)
 
 
 def get_photo(link):
     """Download photo by bytes."""
-    response = requests.get(link)
-    response.raise_for_status()
-    return response.content
+    return client.download(link)
 
 
 def get_product(product_id, access_token):
     """Get a specific product."""
-    response = requests.get(
-        f'https://api.moltin.com/v2/products/{product_id}',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        }
-    )
-    response.raise_for_status()
-    return response.json()['data']
+    def load():
+        response = client.request(
+            'GET', f'/v2/products/{product_id}', access_token,
+        )
+        return response.json()['data']
+    return catalog_cache.get_or_refresh(('product', product_id), load)
 
 
 def get_cart(client_id, access_token):
     """Get a cart."""
-    response = requests.get(
-        f'https://api.moltin.com/v2/carts/{client_id}',
-        headers={'Authorization': f'Bearer {access_token}'},
-    )
-    response.raise_for_status()
+    response = client.request('GET', f'/v2/carts/{client_id}', access_token)
     return response.json()['data']
 
 
 def get_cart_items(client_id, access_token):
     """Get all items in store cart."""
-    response = requests.get(
-        f'https://api.moltin.com/v2/carts/{client_id}/items',
-        headers={'Authorization': f'Bearer {access_token}'},
+    response = client.request(
+        'GET', f'/v2/carts/{client_id}/items', access_token,
     )
-    response.raise_for_status()
     return response.json()['data']
 
 
@@ -88,51 +237,48 @@ def add_to_cart(client_id, product_id, quantity, access_token):
             'type': 'cart_item',
             'quantity': quantity,
         }}
-    response = requests.post(
-        f'https://api.moltin.com/v2/carts/{client_id}/items',
+    response = client.request(
+        'POST',
+        f'/v2/carts/{client_id}/items',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
             'X-MOLTIN-CURRENCY': 'RUB',
         },
         json=payload,
     )
-    response.raise_for_status()
     return response.json()
 
 
 def remove_product_from_cart(product_id, cart_id, access_token):
     """Remove a product from cart."""
-    response = requests.delete(
-        f'https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        },
+    response = client.request(
+        'DELETE', f'/v2/carts/{cart_id}/items/{product_id}', access_token,
     )
-    response.raise_for_status()
+    return response.json()
 
 
 def check_customer(email, access_token):
-    """Get all customers and check if email exists."""
-    response = requests.get(
-        'https://api.moltin.com/v2/customers',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        },
+    """Find customer id by email with moltin filter."""
+    response = client.request(
+        'GET',
+        '/v2/customers',
+        access_token,
+        params={'filter': f'eq(email,{email.lower()})'},
     )
-    response.raise_for_status()
     payload = response.json()
     for customer in payload['data']:
-        if customer['email'] == email.lower():
+        if customer['email'].lower() == email.lower():
             return customer['id']
 
 
 def create_customer(email, access_token):
-    """Create a customer."""
-    response = requests.post(
-        'https://api.moltin.com/v2/customers',
+    """Create a customer and return its id."""
+    response = client.request(
+        'POST',
+        '/v2/customers',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         },
         json={
@@ -143,46 +289,46 @@ def create_customer(email, access_token):
             }
         },
     )
-    response.raise_for_status()
+    return response.json()['data']['id']
 
 
 def create_product(access_token, payload):
     """Create a product."""
-    response = requests.post(
-        'https://api.moltin.com/v2/products',
+    response = client.request(
+        'POST',
+        '/v2/products',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         },
         json={
             'data': payload,
         },
     )
-    response.raise_for_status()
+    catalog_cache.invalidate()
     return response.json()
 
 
 def create_file(access_token, file_location):
     """Create a file."""
-    response = requests.post(
-        'https://api.moltin.com/v2/files',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        },
+    response = client.request(
+        'POST',
+        '/v2/files',
+        access_token,
         files={
             'file_location': (None, file_location)
         }
     )
-    response.raise_for_status()
     return response.json()
 
 
 def create_image_relationship(access_token, productId, imageId):
     """Create relationship between file and product."""
-    response = requests.post(
-        f'https://api.moltin.com/v2/products/{productId}/relationships/main-image',
+    response = client.request(
+        'POST',
+        f'/v2/products/{productId}/relationships/main-image',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         },
         json={
@@ -192,16 +338,17 @@ def create_image_relationship(access_token, productId, imageId):
             },
         }
     )
-    response.raise_for_status()
+    catalog_cache.invalidate()
     return response.json()
 
 
 def create_flow(access_token, name, slug, description, enabled):
     """Create a flow."""
-    response = requests.post(
-        'https://api.moltin.com/v2/flows',
+    response = client.request(
+        'POST',
+        '/v2/flows',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         },
         json={
@@ -214,16 +361,16 @@ def create_flow(access_token, name, slug, description, enabled):
             },
         }
     )
-    response.raise_for_status()
     return response.json()
 
 
 def create_field(access_token, name, slug, field_type, description, required, enabled, flowId):
     """Create a field in flow."""
-    response = requests.post(
-        'https://api.moltin.com/v2/fields',
+    response = client.request(
+        'POST',
+        '/v2/fields',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         },
         json={
@@ -246,22 +393,81 @@ def create_field(access_token, name, slug, field_type, description, required, en
             },
         }
     )
-    response.raise_for_status()
     return response.json()
 
 
 def get_flow(access_token, flowId):
     """Get a flow by flowId."""
-    response = requests.get(
-        f'https://api.moltin.com/v2/flows/{flowId}',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        },
-    )
-    response.raise_for_status()
+    response = client.request('GET', f'/v2/flows/{flowId}', access_token)
     return response.json()
 
 
+def get_pages(path, access_token, params=None):
+    """Yield items of every page of a moltin list."""
+    offset = 0
+    while True:
+        response = client.request(
+            'GET',
+            path,
+            access_token,
+            params={
+                **(params or {}),
+                'page[limit]': PAGE_LIMIT,
+                'page[offset]': offset,
+            },
+        )
+        items = response.json()['data']
+        yield from items
+        if len(items) < PAGE_LIMIT:
+            return
+        offset += PAGE_LIMIT
+
+
+def find_product(sku, access_token):
+    """Find product id by sku with moltin filter."""
+    products = get_pages(
+        '/v2/products', access_token, params={'filter': f'eq(sku,{sku})'},
+    )
+    for product in products:
+        if product.get('sku') == sku:
+            return product['id']
+
+
+def find_file(file_name, access_token):
+    """Find file id by file name with moltin filter."""
+    files = get_pages(
+        '/v2/files',
+        access_token,
+        params={'filter': f'eq(file_name,{file_name})'},
+    )
+    for file in files:
+        if file.get('file_name') == file_name:
+            return file['id']
+
+
+def find_flow(slug, access_token):
+    """Find flow id by slug."""
+    for flow in get_pages('/v2/flows', access_token):
+        if flow['slug'] == slug:
+            return flow['id']
+
+
+def get_field_ids(flow_slug, access_token):
+    """Ids of fields of a flow by their slugs."""
+    return {
+        field['slug']: field['id']
+        for field in get_pages(f'/v2/flows/{flow_slug}/fields', access_token)
+    }
+
+
+def get_entry_ids(flow_slug, field_slug, access_token):
+    """Ids of flow entries by value of one of their fields."""
+    return {
+        entry.get(field_slug): entry['id']
+        for entry in get_pages(f'/v2/flows/{flow_slug}/entries', access_token)
+    }
+
+
 def create_entry(access_token, flow_slug, field_values):
     """Create an entry in flow."""
     json = {
@@ -271,25 +477,25 @@ def create_entry(access_token, flow_slug, field_values):
     }
     for field_slug, field_value in field_values.items():
         json['data'][field_slug] = field_value
-    response = requests.post(
-        f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
+    response = client.request(
+        'POST',
+        f'/v2/flows/{flow_slug}/entries',
+        access_token,
         headers={
-            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
         },
         json=json,
     )
-    response.raise_for_status()
+    if flow_slug == PIZZERIAS_FLOW_SLUG:
+        catalog_cache.invalidate('pizzerias')
     return response.json()
 
 
 def get_all_pizzerias(access_token):
     """Get all entries: pizzerias."""
-    response = requests.get(
-        'https://api.moltin.com/v2/flows/pizzeria-1/entries',
-        headers={
-            'Authorization': f'Bearer {access_token}',
-        },
-    )
-    response.raise_for_status()
-    return response.json()['data']
+    def load():
+        response = client.request(
+            'GET', f'/v2/flows/{PIZZERIAS_FLOW_SLUG}/entries', access_token,
+        )
+        return response.json()['data']
+    return catalog_cache.get_or_refresh('pizzerias', load)
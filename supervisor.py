@@ -0,0 +1,297 @@
+"""Run the bot in several processes, each handling its own share of chats.
+
+The supervisor alone receives updates, by polling or webhook, and puts
+each one into the queue of worker `chat_id % processes`. All updates
+of a chat go to one worker and are handled in order. A worker that
+died or stopped taking updates is replaced. On SIGTERM or SIGINT the
+supervisor stops receiving, lets workers handle what they have taken
+and exits; SIGHUP is passed on to every worker.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telegram
+from dotenv import load_dotenv
+from telegram import Update
+
+from main import DEFAULT_WEBHOOK_PORT, run_worker
+from warmup import DEFAULT_WARMUP_TIMEOUT
+from webhook import set_webhook, start_webhook_server
+
+DEFAULT_PROCESSES = 2
+DEFAULT_HEALTH_TIMEOUT = 30
+DEFAULT_DRAIN_TIMEOUT = 20
+POLL_TIMEOUT = 10
+CHECK_INTERVAL = 5
+
+logger = logging.getLogger('Logger')
+
+
+def get_chat_id(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+class Worker:
+    def __init__(self, number, context, target=run_worker):
+        self.number = number
+        self.context = context
+        self.target = target
+        self.updates = None
+        self.heartbeat = context.Value('d', 0)
+        self.ready = context.Event()
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        """Start a process with a queue of its own.
+
+        A killed process may hold the read lock of its queue forever, so
+        updates still queued for it are lost and the new one gets a new
+        queue.
+        """
+        updates, self.updates = self.updates, self.context.Queue()
+        if updates is not None:
+            updates.close()
+            updates.cancel_join_thread()
+        self.heartbeat.value = time.time()
+        self.ready.clear()
+        self.process = self.context.Process(
+            target=self.target,
+            args=(
+                self.updates, self.heartbeat, self.ready, self.number,
+                os.getpid(),
+            ),
+            name=f'bot-worker-{self.number}',
+        )
+        self.process.start()
+
+    def is_healthy(self, timeout):
+        return (
+            self.process.is_alive()
+            and time.time() - self.heartbeat.value < timeout
+        )
+
+    def stop(self, timeout):
+        """Let worker handle taken updates, kill it after timeout."""
+        self.updates.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.error(f'Worker {self.number} did not stop in time')
+            self.process.kill()
+            self.process.join()
+
+
+class Supervisor:
+    def __init__(self, bot, processes=DEFAULT_PROCESSES,
+                 health_timeout=DEFAULT_HEALTH_TIMEOUT, target=run_worker):
+        self.bot = bot
+        self.health_timeout = health_timeout
+        context = multiprocessing.get_context('spawn')
+        self.workers = [
+            Worker(number, context, target) for number in range(processes)
+        ]
+        self.stopping = threading.Event()
+        self.routed = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def put_update(self, payload):
+        """Route update to its worker, False when stopping."""
+        if self.stopping.is_set():
+            return False
+        chat_id = get_chat_id(Update.de_json(payload, self.bot))
+        self.workers[chat_id % len(self.workers)].updates.put(payload)
+        self.routed += 1
+        return True
+
+    def check_workers(self):
+        """Replace workers that died or stopped taking updates."""
+        for worker in self.workers:
+            if self.stopping.is_set() or worker.is_healthy(
+                    self.health_timeout):
+                continue
+            logger.error(f'Worker {worker.number} is unhealthy, restarting')
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.process.join()
+            worker.restarts += 1
+            worker.start()
+
+    def run_checks(self):
+        while not self.stopping.wait(CHECK_INTERVAL):
+            try:
+                self.check_workers()
+            except Exception:
+                logger.exception('Worker check failed')
+
+    def health(self):
+        workers = [
+            {
+                'number': worker.number,
+                'alive': worker.process.is_alive(),
+                'ready': worker.ready.is_set(),
+                'heartbeat_age': round(
+                    time.time() - worker.heartbeat.value, 1,
+                ),
+                'restarts': worker.restarts,
+            }
+            for worker in self.workers
+        ]
+        healthy = not self.stopping.is_set() and all(
+            worker.is_healthy(self.health_timeout) and worker.ready.is_set()
+            for worker in self.workers
+        )
+        return healthy, json.dumps({
+            'healthy': healthy,
+            'routed': self.routed,
+            'workers': workers,
+        })
+
+    def wait_ready(self, timeout):
+        """Wait until every worker has warmed its caches up."""
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.ready.wait(max(deadline - time.monotonic(), 0))
+        return all(worker.ready.is_set() for worker in self.workers)
+
+    def forward_signal(self, signum, frame):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                os.kill(worker.process.pid, signum)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping.set()
+
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        self.stopping.set()
+        threads = [
+            threading.Thread(target=worker.stop, args=(timeout,))
+            for worker in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def poll(self):
+        """Take updates with long polling until stopping."""
+        offset = None
+        while not self.stopping.is_set():
+            try:
+                updates = self.bot.get_updates(
+                    offset=offset, timeout=POLL_TIMEOUT,
+                )
+            except telegram.error.TelegramError as error:
+                logger.warning(f'Getting updates failed: {error}')
+                self.stopping.wait(1)
+                continue
+            for update in updates:
+                if not self.put_update(update.to_dict()):
+                    break
+                offset = update.update_id + 1
+        if offset is not None:
+            # Confirm routed updates, the rest come to the next start
+            try:
+                self.bot.get_updates(offset=offset, timeout=0, limit=1)
+            except telegram.error.TelegramError as error:
+                logger.warning(f'Confirming updates failed: {error}')
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            healthy, text = self.server.health()
+            status = 200 if healthy else 503
+        else:
+            status, text = 404, ''
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_health_server(health, listen, port):
+    server = ThreadingHTTPServer((listen, port), HealthHandler)
+    server.daemon_threads = True
+    server.health = health
+    threading.Thread(
+        target=server.serve_forever, name='health', daemon=True,
+    ).start()
+    return server
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    tg_token = os.getenv('TELEGRAM_TOKEN')
+    supervisor = Supervisor(
+        telegram.Bot(tg_token),
+        processes=int(os.getenv('BOT_PROCESSES', DEFAULT_PROCESSES)),
+        health_timeout=float(os.getenv(
+            'WORKER_HEALTH_TIMEOUT', DEFAULT_HEALTH_TIMEOUT,
+        )),
+    )
+    supervisor.start()
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    signal.signal(signal.SIGHUP, supervisor.forward_signal)
+    threading.Thread(
+        target=supervisor.run_checks, name='worker-checks', daemon=True,
+    ).start()
+
+    try:
+        listen = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+        warmup_timeout = float(os.getenv(
+            'WARMUP_TIMEOUT', DEFAULT_WARMUP_TIMEOUT,
+        ))
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            secret_path = os.getenv('WEBHOOK_SECRET_PATH', tg_token)
+            secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+            port = int(os.getenv('PORT', DEFAULT_WEBHOOK_PORT))
+            server = start_webhook_server(
+                supervisor.put_update, listen, port, secret_path, secret_token,
+                health=supervisor.health,
+            )
+            webhook_url = os.getenv('WEBHOOK_URL')
+            supervisor.wait_ready(warmup_timeout)
+            if webhook_url:
+                set_webhook(
+                    supervisor.bot, webhook_url, secret_path, secret_token,
+                )
+            logger.warning(
+                f'Supervisor webhook is listening on {listen}:{port}'
+            )
+            supervisor.stopping.wait()
+            server.shutdown()
+        else:
+            health_port = os.getenv('HEALTH_PORT')
+            if health_port:
+                start_health_server(
+                    supervisor.health, listen, int(health_port),
+                )
+            supervisor.wait_ready(warmup_timeout)
+            supervisor.poll()
+    finally:
+        supervisor.drain(float(os.getenv(
+            'DRAIN_TIMEOUT', DEFAULT_DRAIN_TIMEOUT,
+        )))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Resumed imports against the local fake moltin server.
+
+Run with `python -m unittest`.
+"""
+import os
+import tempfile
+import unittest
+from collections import Counter
+
+import store
+from fake_moltin import start_server
+from import_catalog import Checkpoint, Importer
+
+FLOW_SLUG = 'pizzeria-test'
+MENU = [
+    {
+        'id': number,
+        'name': f'Пицца {number}',
+        'description': 'Описание',
+        'price': 500,
+        'product_image': {'url': f'https://example.com/{number}.jpg'},
+    }
+    for number in range(6)
+]
+ADDRESSES = [
+    {
+        'id': f'pizzeria-{number}',
+        'alias': f'Пиццерия {number}',
+        'address': {'full': f'Улица {number}'},
+        'coordinates': {'lon': '37.6', 'lat': '55.7'},
+    }
+    for number in range(5)
+]
+
+
+class Interrupted(Exception):
+    pass
+
+
+class CrashingCheckpoint(Checkpoint):
+    """Checkpoint that fails to save `crash_keys`, as if killed."""
+
+    def __init__(self, path, crash_keys):
+        super().__init__(path)
+        self.crash_keys = crash_keys
+
+    def save(self, key, value):
+        if key in self.crash_keys:
+            raise Interrupted(key)
+        super().save(key, value)
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(products_count=0)
+        store.configure_client(base_url=self.server.url)
+        self.page_limit = store.PAGE_LIMIT
+        store.PAGE_LIMIT = 2
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint_path = os.path.join(directory.name, 'checkpoint.json')
+
+    def tearDown(self):
+        store.PAGE_LIMIT = self.page_limit
+        store.configure_client()
+        self.server.shutdown()
+
+    def run_import(self, checkpoint):
+        importer = Importer('token', checkpoint, workers=4)
+        try:
+            importer.import_menu(MENU)
+            importer.import_pizzerias(ADDRESSES, 1, flow_slug=FLOW_SLUG)
+        finally:
+            # A killed import creates nothing more, unlike threads left
+            # running after an exception
+            importer.executor.shutdown()
+        return importer
+
+    def test_fresh_import_makes_no_lookups(self):
+        importer = self.run_import(Checkpoint(self.checkpoint_path))
+        self.assertEqual(self.server.requests, importer.calls)
+
+    def test_resumed_import_creates_nothing_twice(self):
+        # Every run stops right after creating some of the resources,
+        # the later ones lie past the first page of lookups
+        runs = [
+            {'file:3', 'product:4'},
+            {f'flow:{FLOW_SLUG}'},
+            {f'field:{FLOW_SLUG}:telegram_id_01'},
+            {f'entry:{FLOW_SLUG}:pizzeria-4'},
+        ]
+        for crash_keys in runs:
+            with self.assertRaises(Interrupted):
+                self.run_import(
+                    CrashingCheckpoint(self.checkpoint_path, crash_keys),
+                )
+        self.run_import(Checkpoint(self.checkpoint_path))
+
+        state = self.server.state
+        self.assertEqual(len(state.files), len(MENU))
+        skus = Counter(product['sku'] for product in state.products.values())
+        self.assertEqual(skus, Counter(str(item['id']) for item in MENU))
+        for product in state.products.values():
+            image = product['relationships']['main_image']['data']
+            self.assertIn(image['id'], state.files)
+        self.assertEqual(len(state.flows), 1)
+        self.assertEqual(len(state.fields), 5)
+        aliases = Counter(entry['alias'] for entry in state.entries[FLOW_SLUG])
+        self.assertEqual(
+            aliases, Counter(pizzeria['alias'] for pizzeria in ADDRESSES),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""Concurrency checks of the shared request budget and retry delays.
+
+Run with `python -m unittest`. The redis bucket is checked against
+fakeredis with Lua support (`pip install fakeredis[lua]`) and skipped
+without it.
+"""
+import email.utils
+import threading
+import time
+import unittest
+
+import redis
+
+from rate_limit import RedisTokenBucket, TokenBucket, get_retry_after
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+RATE = 20
+CAPACITY = 2
+THREADS = 8
+CALLS = 5
+
+
+def acquire_concurrently(bucket):
+    """Seconds taken by THREADS threads to get CALLS tokens each."""
+    def acquire():
+        for _ in range(CALLS):
+            bucket.acquire()
+    threads = [threading.Thread(target=acquire) for _ in range(THREADS)]
+    started_at = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started_at
+
+
+def get_min_elapsed():
+    """Burst of CAPACITY tokens is free, the rest come at RATE."""
+    return (THREADS * CALLS - CAPACITY) / RATE
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_concurrent_callers_share_rate(self):
+        elapsed = acquire_concurrently(TokenBucket(RATE, CAPACITY))
+        self.assertGreaterEqual(elapsed, get_min_elapsed() * 0.95)
+
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(get_retry_after({'Retry-After': '2'}), 2)
+
+    def test_malformed_header_falls_back_to_backoff(self):
+        self.assertIsNone(get_retry_after({'Retry-After': 'garbage'}))
+        self.assertIsNone(get_retry_after({'Retry-After': 'nan'}))
+
+    def test_date_without_time_zone_is_utc(self):
+        retry_at = email.utils.formatdate(time.time() + 60)
+        naive = retry_at.replace('-0000', '').strip()
+        for header in (retry_at, naive, f'{naive} GMT'):
+            self.assertAlmostEqual(
+                get_retry_after({'Retry-After': header}), 60, delta=2,
+            )
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisTokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.db = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection,
+            server=fakeredis.FakeServer(),
+        ))
+
+    def test_concurrent_callers_share_rate(self):
+        bucket = RedisTokenBucket(self.db, 'budget', RATE, CAPACITY)
+        elapsed = acquire_concurrently(bucket)
+        self.assertGreaterEqual(elapsed, get_min_elapsed() * 0.95)
+
+    def test_waiting_caller_reserves_token(self):
+        bucket = RedisTokenBucket(self.db, 'budget', RATE, 1)
+        now = time.time()
+        waits = [
+            float(bucket.script(
+                keys=[bucket.key], args=[RATE, 1, now],
+            ))
+            for _ in range(3)
+        ]
+        self.assertEqual(waits, [0, 1 / RATE, 2 / RATE])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Moltin clients against the local fake moltin server.
+
+Run with `python -m unittest`.
+"""
+import time
+import unittest
+
+import requests
+
+import async_store
+import store
+from circuit import CircuitOpenError, breakers
+from fake_moltin import start_server
+from metrics import get_moltin_endpoint
+
+RESET_TIMEOUT = 0.1
+
+
+class FlakyLimiter:
+    """Rate limiter whose store is down until `failing` is cleared."""
+
+    def __init__(self):
+        self.failing = True
+
+    def acquire(self):
+        if self.failing:
+            raise ConnectionError('rate limit store is down')
+        return False
+
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.limiter = FlakyLimiter()
+        breakers.configure(failure_threshold=1, reset_timeout=RESET_TIMEOUT)
+        breaker = breakers.get(
+            f'moltin {get_moltin_endpoint("GET", "/v2/products")}',
+        )
+        breaker.record(0, failed=True)
+        time.sleep(RESET_TIMEOUT)
+
+    def tearDown(self):
+        breakers.configure()
+        self.server.shutdown()
+
+    def test_limiter_error_keeps_half_open_trial(self):
+        client = store.MoltinClient(
+            base_url=self.server.url, rate_limiter=self.limiter,
+        )
+        with self.assertRaises(ConnectionError):
+            client.request('GET', '/v2/products')
+        self.limiter.failing = False
+        try:
+            client.request('GET', '/v2/products')
+        except CircuitOpenError:
+            self.fail('Breaker stayed half open after limiter error')
+        finally:
+            client.close()
+
+    def test_async_limiter_error_keeps_half_open_trial(self):
+        client = async_store.AsyncMoltinClient(
+            base_url=self.server.url, rate_limiter=self.limiter,
+        )
+        with self.assertRaises(ConnectionError):
+            async_store.run(client.request('GET', '/v2/products'))
+        self.limiter.failing = False
+        try:
+            async_store.run(client.request('GET', '/v2/products'))
+        except CircuitOpenError:
+            self.fail('Breaker stayed half open after limiter error')
+        finally:
+            async_store.run(client.close())
+
+
+class AsyncErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_error_status_raises_like_sync_client(self):
+        client = async_store.AsyncMoltinClient(base_url=self.server.url)
+        try:
+            with self.assertRaises(requests.HTTPError) as error:
+                async_store.run(client.request('GET', '/v2/products/none'))
+        finally:
+            async_store.run(client.close())
+        self.assertEqual(error.exception.response.status_code, 404)
+        self.assertIn('404 Client Error: Not Found', str(error.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Restart of sharded worker processes.
+
+Run with `python -m unittest`.
+"""
+import multiprocessing
+import time
+import unittest
+from functools import partial
+
+from supervisor import Supervisor
+
+START_TIMEOUT = 30
+
+
+def forward_updates(received, updates, heartbeat, ready, worker_number,
+                    parent_pid):
+    """Worker that passes every update on to `received`."""
+    ready.set()
+    while True:
+        payload = updates.get()
+        if payload is None:
+            return
+        received.put(payload['update_id'])
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.received = multiprocessing.get_context('spawn').Queue()
+        self.supervisor = Supervisor(
+            None, processes=1, health_timeout=START_TIMEOUT,
+            target=partial(forward_updates, self.received),
+        )
+        self.supervisor.start()
+        self.worker, = self.supervisor.workers
+        self.assertTrue(self.supervisor.wait_ready(START_TIMEOUT))
+
+    def tearDown(self):
+        self.supervisor.drain(timeout=5)
+
+    def test_restarted_worker_gets_updates(self):
+        self.supervisor.put_update({'update_id': 1})
+        self.assertEqual(self.received.get(timeout=START_TIMEOUT), 1)
+
+        # Killed while blocked in get(), holding the queue read lock.
+        # The pause lets its feeder thread release the `received` lock.
+        time.sleep(1)
+        self.worker.heartbeat.value = 0
+        self.supervisor.check_workers()
+        self.assertEqual(self.worker.restarts, 1)
+        self.assertTrue(self.supervisor.wait_ready(START_TIMEOUT))
+
+        for update_id in (2, 3, 4):
+            self.supervisor.put_update({'update_id': update_id})
+        received = [
+            self.received.get(timeout=START_TIMEOUT) for _ in range(3)
+        ]
+        self.assertEqual(received, [2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
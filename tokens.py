@@ -0,0 +1,118 @@
+"""Moltin access token kept in memory and refreshed in background."""
+import logging
+import threading
+import time
+
+from store import authenticate
+
+TOKEN_KEY = 'token'
+TOKEN_EXPIRATION_KEY = 'token_expiration'
+TOKEN_LOCK_KEY = 'token_refresh_lock'
+DEFAULT_REFRESH_MARGIN = 5 * 60
+
+logger = logging.getLogger('Logger')
+
+
+class TokenProvider:
+    """Moltin token shared by threads, processes and bot replicas.
+
+    The token lives in memory and in redis. Only the holder of a redis
+    lock authenticates, others pick the fresh token up from redis.
+    """
+
+    def __init__(self, db, client_id, client_secret,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN):
+        self.db = db
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def is_fresh(self):
+        return self.expires - self.refresh_margin > time.time()
+
+    def get_token(self):
+        """Return current token, refreshing it only when it is stale."""
+        if not self.is_fresh():
+            with self._lock:
+                if not self.is_fresh():
+                    self.refresh()
+        return self.token
+
+    def load(self):
+        """Take token from redis, if some worker has refreshed it."""
+        pipeline = self.db.pipeline(transaction=False)
+        pipeline.get(TOKEN_KEY)
+        pipeline.get(TOKEN_EXPIRATION_KEY)
+        token, expires = pipeline.execute()
+        if token and expires and int(expires) > self.expires:
+            self.token = token.decode('utf-8')
+            self.expires = int(expires)
+        return self.is_fresh()
+
+    def refresh(self):
+        if self.load():
+            return
+        lock = self.db.lock(TOKEN_LOCK_KEY, timeout=30, blocking_timeout=15)
+        acquired = lock.acquire()
+        try:
+            if acquired and self.load():
+                return
+            moltin_token = authenticate(self.client_id, self.client_secret)
+            self.token = moltin_token['token']
+            self.expires = int(moltin_token['expires'])
+            pipeline = self.db.pipeline(transaction=False)
+            pipeline.set(TOKEN_KEY, self.token)
+            pipeline.set(TOKEN_EXPIRATION_KEY, self.expires)
+            pipeline.execute()
+            logger.error('Token updated')
+        finally:
+            if acquired:
+                lock.release()
+
+    def run(self):
+        while not self._stopped.is_set():
+            delay = self.expires - self.refresh_margin - time.time()
+            if self._stopped.wait(max(delay, 1)):
+                break
+            try:
+                self.get_token()
+            except Exception:
+                logger.exception('Token refresh failed')
+
+    def start(self, prefetch=True):
+        """Keep token refreshed before expiration.
+
+        With `prefetch` the first token is got before returning,
+        otherwise on first use or by the refresh thread.
+        """
+        if prefetch:
+            self.get_token()
+        threading.Thread(
+            target=self.run, name='token-refresh', daemon=True,
+        ).start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+token_provider = None
+
+
+def start_token_provider(db, client_id, client_secret,
+                         refresh_margin=DEFAULT_REFRESH_MARGIN,
+                         prefetch=True):
+    global token_provider
+    token_provider = TokenProvider(
+        db, client_id, client_secret, refresh_margin,
+    )
+    token_provider.start(prefetch)
+    return token_provider
+
+
+def get_token():
+    """Current moltin token without network round trips."""
+    return token_provider.get_token()
@@ -0,0 +1,92 @@
+"""Concurrent cache warm-up run once at start.
+
+Tasks run in parallel threads, so start time is the slowest task rather
+than the sum of all. `ready` is set only when every task has succeeded:
+failed tasks are run again after a growing delay, and until they pass
+/healthz reports the bot as not ready.
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WARMUP_TIMEOUT = 60
+DEFAULT_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+logger = logging.getLogger('Logger')
+
+
+class WarmUp:
+    def __init__(self):
+        self.ready = threading.Event()
+        self.started_at = None
+        self.elapsed = None
+        self.timings = {}
+        self.errors = {}
+
+    def run_task(self, name, task):
+        started_at = time.perf_counter()
+        try:
+            task()
+        except Exception as error:
+            self.errors[name] = repr(error)
+            logger.exception(f'Warm-up of {name} failed')
+        else:
+            self.errors.pop(name, None)
+        finally:
+            self.timings[name] = time.perf_counter() - started_at
+
+    def run(self, tasks, on_ready=None, attempts=None,
+            retry_delay=DEFAULT_RETRY_DELAY):
+        """Run `tasks`, a dict of name and callable, then set ready.
+
+        Failed tasks are retried up to `attempts` runs in total, forever
+        if it is None. Without success ready stays unset.
+        """
+        self.started_at = time.perf_counter()
+        attempt = 1
+        while True:
+            with ThreadPoolExecutor(
+                    max_workers=max(len(tasks), 1),
+                    thread_name_prefix='warm-up') as executor:
+                for name, task in tasks.items():
+                    executor.submit(self.run_task, name, task)
+            if not self.errors or attempt == attempts:
+                break
+            tasks = {name: tasks[name] for name in self.errors}
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+            attempt += 1
+        if self.errors:
+            return
+        self.elapsed = time.perf_counter() - self.started_at
+        self.ready.set()
+        if on_ready:
+            on_ready()
+
+    def start(self, tasks, on_ready=None):
+        threading.Thread(
+            target=self.run, args=(tasks, on_ready), name='warm-up',
+            daemon=True,
+        ).start()
+
+    def wait(self, timeout=DEFAULT_WARMUP_TIMEOUT):
+        return self.ready.wait(timeout)
+
+    def health(self):
+        """Readiness and timings for /healthz."""
+        ready = self.ready.is_set()
+        return ready, json.dumps({
+            'ready': ready,
+            'elapsed': round(self.elapsed, 3) if ready else None,
+            'timings': {
+                name: round(elapsed, 3)
+                for name, elapsed in self.timings.items()
+            },
+            'errors': self.errors,
+        })
+
+
+warm_up = WarmUp()
@@ -0,0 +1,125 @@
+"""Webhook mode: embedded http server feeding Telegram updates to bot."""
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger('Logger')
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept updates posted by Telegram to the secret path."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, text=''):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            healthy, text = self.server.health()
+            self.reply(200 if healthy else 503, text)
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        if self.path != self.server.webhook_path:
+            self.reply(404)
+            return
+        secret_token = self.server.secret_token
+        if secret_token and self.headers.get(
+                SECRET_TOKEN_HEADER) != secret_token:
+            self.reply(403)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.reply(400)
+            return
+        if not self.server.put_update(payload):
+            # Telegram sends the update again after an error reply
+            self.reply(503)
+            return
+        self.reply(200, 'ok')
+
+
+def report_healthy():
+    return True, 'ok'
+
+
+def start_webhook_server(put_update, listen, port, secret_path,
+                         secret_token=None, health=report_healthy):
+    """Start webhook server in a daemon thread.
+
+    `put_update` gets every update as decoded json and returns whether
+    it took the update, `health` returns whether the bot is healthy and
+    the text for /healthz.
+    """
+    server = ThreadingHTTPServer((listen, port), WebhookHandler)
+    server.daemon_threads = True
+    server.put_update = put_update
+    server.health = health
+    server.webhook_path = f'/{secret_path}'
+    server.secret_token = secret_token
+    threading.Thread(
+        target=server.serve_forever, name='webhook', daemon=True,
+    ).start()
+    return server
+
+
+def set_webhook(bot, webhook_url, secret_path, secret_token=None):
+    api_kwargs = {'secret_token': secret_token} if secret_token else None
+    bot.set_webhook(
+        url=f'{webhook_url.rstrip("/")}/{secret_path}',
+        api_kwargs=api_kwargs,
+    )
+
+
+def run_webhook(updater, listen, port, secret_path, secret_token=None,
+                webhook_url=None, health=report_healthy):
+    """Serve updates from webhook until the process is stopped.
+
+    Telegram is told about the webhook only when `webhook_url` is set,
+    so extra replicas behind a load balancer start without touching
+    the bot settings and without polling. On SIGTERM or SIGINT the
+    server stops and taken updates are handled before returning.
+    """
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        stopped.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    dispatcher = updater.dispatcher
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(
+        target=dispatcher.start, name='dispatcher',
+    )
+    dispatcher_thread.start()
+
+    def put_update(payload):
+        dispatcher.update_queue.put(Update.de_json(payload, updater.bot))
+        return True
+    server = start_webhook_server(
+        put_update, listen, port, secret_path, secret_token, health,
+    )
+    if webhook_url:
+        set_webhook(updater.bot, webhook_url, secret_path, secret_token)
+    logger.warning(f'Webhook is listening on {listen}:{port}')
+    stopped.wait()
+    server.shutdown()
+    dispatcher.stop()
+    updater.job_queue.stop()
+    dispatcher_thread.join()